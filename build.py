@@ -90,6 +90,12 @@ def build_parser():
       help='number of make threads to use',
       default=8,
   )
+  AP.add_argument(
+      '--timeout',
+      help='seconds before a sub command and its process group are killed',
+      type=float,
+      default=None,
+  )
   AP.add_argument(
       '--project-dir',
       help='path to the project',
@@ -150,6 +156,46 @@ def build_parser():
       help='path to the vcpkg json config',
       default='etc/vcpkg/vcpkg.json',
   )
+  vcpkg.add_argument(
+      '--jobs',
+      help='total build jobs shared by concurrent vcpkg installs',
+      type=int,
+      default=os.cpu_count(),
+  )
+  vcpkg.add_argument(
+      '--parallel-triplets',
+      help='maximum number of triplets installed concurrently, they share\n'
+      'the jobs budget and wait on the vcpkg install root lock',
+      type=int,
+      default=1,
+  )
+  vcpkg.add_argument(
+      '--force',
+      help='install every package even if the status db shows it up to date',
+      action='store_true',
+  )
+  vcpkg.add_argument(
+      '--binary-cache',
+      help='directory or http url used as the vcpkg binary cache\n'
+      'defaults to "binary_cache" in the vcpkg json config',
+      default=None,
+  )
+  vcpkg.add_argument(
+      '--binary-cache-max-gb',
+      help='prune least recently used binary cache archives beyond this size',
+      type=float,
+      default=None,
+  )
+  vcpkg.add_argument(
+      '--prefetch',
+      help='download sources for all stale ports before building',
+      action='store_true',
+  )
+  vcpkg.add_argument(
+      '--mirror',
+      help='local directory of source archives to seed vcpkg downloads from',
+      default=None,
+  )
 
   return AP
 
@@ -167,6 +213,9 @@ class Build():
     self.clean = self.uninstall = self.test = self.lint = None
     self.toolchain_path = self.vcpkg_json = self.xcode_proj = None
     self.bundle_path = self.file_log = self.file_verbose = None
+    self.timeout = self.jobs = self.parallel_triplets = self.force = None
+    self.binary_cache = self.binary_cache_max_gb = None
+    self.prefetch = self.mirror = None
 
     args = vm_build_utils.cmd.parse_args(build_parser())
 
@@ -223,8 +272,9 @@ class Build():
           cwd=str(cwd),
           run_mode=self.run_mode,
           log_level=logging.INFO,
+          timeout=self.timeout,
       )
-    except subprocess.CalledProcessError:
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
       sys.exit(666)
 
   @staticmethod
@@ -247,8 +297,16 @@ class Build():
         self.run_mode,
         self.project_dir,
         self.vcpkg_json,
+        timeout=self.timeout,
+        jobs=self.jobs,
+        parallel_triplets=self.parallel_triplets,
+        force=self.force,
+        binary_cache=self.binary_cache,
+        binary_cache_max_gb=self.binary_cache_max_gb,
     )
     vcpkg_build.bootstrap()
+    if self.prefetch:
+      vcpkg_build.prefetch(self.mirror)
     vcpkg_build.build()
 
   def run_lint(self):
@@ -6,23 +6,47 @@
 
 # include( retina_icons )
 
-# build_retina_icons( vm.appiconset vm.png )
-# build_retina_icons( record-button.imageset record-button.png )
+# build_retina_icons( vm.appiconset vm.png pad )
+# build_retina_icons( record-button.imageset record-button.png copy release )
 
 # add_custom_target( node_one_icons ALL DEPENDS ${iconsets} )
 
+# iconsets collects the .retina_icons.json manifest of each iconset, the
+# manifest is refreshed on every run and serves as the build stamp while the
+# pngs themselves are only rewritten when their bytes change
+
 set( retina_icons_script ${CMAKE_SOURCE_DIR}/build/vm_build_utils/retina_icons.py )
 
 set( asset_build_directory ${CMAKE_CURRENT_BINARY_DIR}/${asset_name})
 
+# png encoding profile used when a call does not pass one: default, fast for
+# iterative dev builds or release for the smallest bundle. a non zero
+# RETINA_ICONS_QUANTIZE_BITS posterizes release outputs to that many bits
+set( RETINA_ICONS_PROFILE default CACHE STRING "retina icons png profile: default, fast or release" )
+set( RETINA_ICONS_QUANTIZE_BITS 0 CACHE STRING "posterize release retina icons to this many bits per channel, 0 to keep all" )
+
+macro( retina_icons_encode_args profile )
+  set( retina_icons_encode_args --profile ${profile} )
+  if( "${profile}" STREQUAL "release" AND RETINA_ICONS_QUANTIZE_BITS )
+    list( APPEND retina_icons_encode_args --quantize-bits ${RETINA_ICONS_QUANTIZE_BITS} )
+  endif()
+endmacro(retina_icons_encode_args)
+
 include(GNUInstallDirs)
 
+# an optional fourth argument overrides RETINA_ICONS_PROFILE
 macro( build_retina_icons iconset_name src_icon_name pad_mode )
 
+  if( ${ARGC} GREATER 3 )
+    retina_icons_encode_args( ${ARGV3} )
+  else()
+    retina_icons_encode_args( ${RETINA_ICONS_PROFILE} )
+  endif()
+
   set( output_iconset ${asset_build_directory}/${iconset_name} )
-  list(APPEND iconsets ${output_iconset})
+  list(APPEND iconsets ${output_iconset}/.retina_icons.json)
 
-  add_custom_command( OUTPUT ${output_iconset}
+  add_custom_command( OUTPUT ${output_iconset}/.retina_icons.json
     COMMAND
       ${PYTHON_EXECUTABLE}
       ${retina_icons_script}
@@ -31,6 +55,8 @@ macro( build_retina_icons iconset_name src_icon_name pad_mode )
       --iconset ${iconset_name}
       --src ${CMAKE_CURRENT_SOURCE_DIR}/${src_icon_name}
       --pad-mode ${pad_mode}
+      ${retina_icons_encode_args}
+    DEPENDS ${CMAKE_CURRENT_SOURCE_DIR}/${src_icon_name}
     WORKING_DIRECTORY ${CMAKE_CURRENT_BINARY_DIR}
     COMMENT "Generating icons"
   )
@@ -38,6 +64,68 @@ macro( build_retina_icons iconset_name src_icon_name pad_mode )
   install(
     DIRECTORY ${output_iconset}
     DESTINATION ${CMAKE_INSTALL_PREFIX}/icons/${asset_name}
+    PATTERN .retina_icons.json EXCLUDE
   )
 
 endmacro(build_retina_icons)
+
+# build several iconsets with a single python process, each distinct src
+# image is decoded once. RETINA_ICONS_PROFILE picks the png profile.
+# arguments are iconset / src / pad_mode triples:
+# build_retina_icons_batch( node_one
+#   vm.appiconset vm.png pad
+#   record-button.imageset record-button.png copy
+# )
+macro( build_retina_icons_batch batch_name )
+
+  set( batch_manifest ${CMAKE_CURRENT_BINARY_DIR}/${batch_name}_retina_icons.json )
+  set( batch_args ${ARGN} )
+  set( batch_outputs "" )
+  set( batch_depends "" )
+  set( batch_entries "" )
+
+  list( LENGTH batch_args batch_length )
+  math( EXPR batch_last "${batch_length} - 1" )
+
+  foreach( batch_index RANGE 0 ${batch_last} 3 )
+    math( EXPR batch_src_index "${batch_index} + 1" )
+    math( EXPR batch_pad_index "${batch_index} + 2" )
+    list( GET batch_args ${batch_index} batch_iconset )
+    list( GET batch_args ${batch_src_index} batch_src )
+    list( GET batch_args ${batch_pad_index} batch_pad_mode )
+
+    set( output_iconset ${asset_build_directory}/${batch_iconset} )
+    list( APPEND iconsets ${output_iconset}/.retina_icons.json )
+    list( APPEND batch_outputs ${output_iconset}/.retina_icons.json )
+    list( APPEND batch_depends ${CMAKE_CURRENT_SOURCE_DIR}/${batch_src} )
+    list( APPEND batch_entries
+      "{\"iconset\": \"${batch_iconset}\", \"src\": \"${CMAKE_CURRENT_SOURCE_DIR}/${batch_src}\", \"pad_mode\": \"${batch_pad_mode}\"}" )
+
+    install(
+      DIRECTORY ${output_iconset}
+      DESTINATION ${CMAKE_INSTALL_PREFIX}/icons/${asset_name}
+      PATTERN .retina_icons.json EXCLUDE
+    )
+  endforeach()
+
+  retina_icons_encode_args( ${RETINA_ICONS_PROFILE} )
+
+  # only touch the manifest when its content changes so builds stay incremental
+  string( REPLACE ";" ",\n  " batch_json "${batch_entries}" )
+  file( WRITE ${batch_manifest}.tmp "[\n  ${batch_json}\n]\n" )
+  configure_file( ${batch_manifest}.tmp ${batch_manifest} COPYONLY )
+
+  add_custom_command( OUTPUT ${batch_outputs}
+    COMMAND
+      ${PYTHON_EXECUTABLE}
+      ${retina_icons_script}
+      --verbose
+      --asset-build-dir ${asset_build_directory}
+      --manifest ${batch_manifest}
+      ${retina_icons_encode_args}
+    DEPENDS ${batch_manifest} ${batch_depends}
+    WORKING_DIRECTORY ${CMAKE_CURRENT_BINARY_DIR}
+    COMMENT "Generating icons for ${batch_name}"
+  )
+
+endmacro(build_retina_icons_batch)
@@ -5,17 +5,28 @@ batch and commandline utilities
 '''
 from __future__ import print_function
 import gc
+import io
 import os
+import csv
+import gzip
+import queue
+import atexit
+import signal
 import ssl
 import sys
+import json
 import site
+import hashlib
+import tempfile
 import shlex
 import logging
+import logging.handlers
 import warnings
 import argparse
 import platform
 import resource
 import subprocess
+import threading
 import time
 
 if sys.version_info.major < 3 or sys.version_info.minor < 5:
@@ -28,9 +39,13 @@ try:
 except ImportError:
   numpy = None
 try:
-  from pynvml.smi import nvidia_smi
+  import pynvml
 except ImportError:
-  nvidia_smi = None
+  pynvml = None
+try:
+  import psutil
+except ImportError:
+  psutil = None
 
 CODE_RESET = '\033[0m'
 CODE_BLACK = '\033[1;30m'
@@ -58,6 +73,7 @@ def confirm(run_mode, cmd_str):
     return False
 
   if not USER_CONFIRM_ALWAYS and run_mode == RUN_CMD_CONFIRM:
+    flush_logging()
     c = input('run command [%s] ? (N)o / (Y)es / (A)lways:' % (cmd_str))
 
     if not isinstance(c, str) or c == '':
@@ -149,6 +165,15 @@ def execute(
     color=True,
     log_level=logging.DEBUG,
     env=None,
+    sample_path=None,
+    sample_interval=1.0,
+    timeout=None,
+    log_path=None,
+    stderr=None,
+    on_line=None,
+    cache=None,
+    cache_env=(),
+    cache_inputs=(),
 ):
   '''
   execute a subprocess with
@@ -156,6 +181,16 @@ def execute(
     optional color coded output
     optional current working directory override
     a run mode that can disable execution, ask for user confirmation, or execute
+    optional resource sampling of the process tree to a .csv or .json file
+    an optional timeout in seconds after which the process group of the
+      command is terminated and subprocess.TimeoutExpired is raised
+    an optional log_path that receives stdout and stderr instead of the terminal
+    optional stderr redirection with output=True, subprocess.STDOUT merges it
+    an optional on_line callback receiving each line of stdout and stderr
+      instead of the terminal, lines also go to log_path when both are given
+    an optional CommandCache for read only commands run with output=True
+      results are keyed by cmd, cwd, the cache_env variables and the stat
+      (or hash) of each path in cache_inputs
   '''
 
   nottext = color_text('not', CODE_RED) if color else 'not'
@@ -167,6 +202,19 @@ def execute(
   go = confirm(run_mode, cmd_str)
   verb = 'running' if go else nottext + ' running'
 
+  cache_key = result = None
+  if go and cache is not None:
+    if not output:
+      raise ValueError('cache requires output=True')
+    if not cache_env and not cache_inputs:
+      logging.debug(
+          'caching [%s] without cache_env or cache_inputs, '
+          'the entry is reused until it is evicted', cmd_str)
+    cache_key = cache.key(cmd, cwd, env, cache_env, cache_inputs)
+    result = cache.get(cache_key)
+    if result is not None:
+      verb = 'cached'
+
   highlight_color = (CODE_YELLOW if go else CODE_GREEN) if color else None
   result_color = CODE_CYAN if color else None
 
@@ -178,22 +226,346 @@ def execute(
   else:
     logging.log(log_level, 'from [%s] %s [%s]', cwd_str, verb, cmd_str)
 
-  if not go:
-    return None
+  if not go or result is not None:
+    return result
+
+  sampler = None
+  if sample_path is not None:
+    sampler = ResourceSampler(sample_path, interval=sample_interval)
+
+  if on_line is not None and log_path is not None:
+    if output:
+      raise ValueError('on_line requires output=False')
+    with open(log_path, 'wb') as log_fd:
+
+      def log_line(line):
+        log_fd.write(line)
+        on_line(line)
+
+      communicate(
+          cmd,
+          cwd=cwd,
+          env=env,
+          sampler=sampler,
+          timeout=timeout,
+          on_line=log_line,
+      )
+
+  elif log_path is not None:
+    if output:
+      raise ValueError('log_path requires output=False')
+    with open(log_path, 'wb') as log_fd:
+      communicate(
+          cmd,
+          cwd=cwd,
+          env=env,
+          sampler=sampler,
+          stdout=log_fd,
+          stderr=subprocess.STDOUT,
+          timeout=timeout,
+      )
+
+  elif on_line is not None:
+    if output:
+      raise ValueError('on_line requires output=False')
+    communicate(
+        cmd,
+        cwd=cwd,
+        env=env,
+        sampler=sampler,
+        timeout=timeout,
+        on_line=on_line,
+    )
 
-  if not output:
+  elif not output:
+    flush_logging()
     color_code_stdout(result_color)
     try:
-      subprocess.check_call(cmd, cwd=cwd, env=env)
+      communicate(cmd, cwd=cwd, env=env, sampler=sampler, timeout=timeout)
     finally:
       reset_color_code_stdout(color)
 
   else:
-    return subprocess.check_output(cmd, cwd=cwd, env=env)
+    result = communicate(
+        cmd,
+        cwd=cwd,
+        env=env,
+        sampler=sampler,
+        stdout=subprocess.PIPE,
+        stderr=stderr,
+        timeout=timeout,
+    )
+    if cache_key is not None:
+      cache.put(cache_key, result)
+    return result
 
   return None
 
 
+def user_cache_dir(name=''):
+  'per user cache directory for vm_build_utils, honours XDG_CACHE_HOME'
+  root = os.environ.get('XDG_CACHE_HOME')
+  if not root:
+    root = os.path.join(os.path.expanduser('~'), '.cache')
+  return Path(root) / 'vm_build_utils' / name
+
+
+def atomic_write(path, data):
+  'replace path with bytes or str data through a temporary file + os.replace'
+  path = Path(path)
+  path.parent.mkdir(parents=True, exist_ok=True)
+  fd, tmp_path = tempfile.mkstemp(dir=str(path.parent), suffix='.tmp')
+  try:
+    with os.fdopen(fd, 'wb' if isinstance(data, bytes) else 'w') as tmp:
+      tmp.write(data)
+    os.replace(tmp_path, str(path))
+  except BaseException:
+    try:
+      os.unlink(tmp_path)
+    except FileNotFoundError:
+      pass
+    raise
+
+
+def prune_lru(paths, max_bytes):
+  '''
+  delete the least recently modified of paths until their total size is at
+  most max_bytes, returns the deleted paths
+  '''
+  entries = []
+  total = 0
+  for path in paths:
+    try:
+      stat = os.stat(str(path))
+    except FileNotFoundError:
+      continue
+    entries.append((stat.st_mtime, stat.st_size, path))
+    total += stat.st_size
+
+  pruned = []
+  for _, size, path in sorted(entries, key=lambda x: x[:2]):
+    if total <= max_bytes:
+      break
+    try:
+      os.unlink(str(path))
+      pruned.append(path)
+    except FileNotFoundError:
+      pass
+    total -= size
+  return pruned
+
+
+class CommandCache(object):
+  '''
+  on disk cache of stdout for read only commands: see execute(cache=...)
+  one file per entry, mtime is bumped on every hit so the least recently
+  used entries are evicted first once the directory grows beyond max_bytes
+  '''
+
+  def __init__(self, directory=None, max_bytes=32 * 2**20, hash_inputs=False):
+    if directory is None:
+      directory = user_cache_dir('cmd')
+    self.directory = Path(directory)
+    self.max_bytes = max_bytes
+    self.hash_inputs = hash_inputs
+    self.hits = self.misses = 0
+
+  def input_signature(self, path):
+    'mtime and size of a path, or a content hash if hash_inputs'
+    path = Path(path)
+    try:
+      if self.hash_inputs:
+        with open(path, 'rb') as fd:
+          return hashlib.sha256(fd.read()).hexdigest()
+      stat = path.stat()
+      return [stat.st_mtime_ns, stat.st_size]
+    except (IsADirectoryError, FileNotFoundError, NotADirectoryError):
+      return None
+
+  def key(self, cmd, cwd=None, env=None, env_keys=(), inputs=()):
+    'hex digest identifying a command and the state it reads'
+    if env is None:
+      env = os.environ
+    description = dict(
+        cmd=[str(x) for x in cmd],
+        cwd=os.path.abspath(str(cwd if cwd is not None else os.getcwd())),
+        env=[(k, env.get(k)) for k in sorted(env_keys)],
+        inputs=[(str(x), self.input_signature(x)) for x in inputs],
+    )
+    encoded = json.dumps(description, sort_keys=True).encode('utf-8')
+    return hashlib.sha256(encoded).hexdigest()
+
+  def path(self, key):
+    'path to the file holding an entry'
+    return self.directory / key
+
+  def get(self, key):
+    'cached bytes or None on a miss'
+    path = self.path(key)
+    try:
+      with open(path, 'rb') as fd:
+        result = fd.read()
+      os.utime(path)
+    except FileNotFoundError:
+      self.misses += 1
+      return None
+    self.hits += 1
+    return result
+
+  def put(self, key, value):
+    'atomically store bytes for key then evict old entries'
+    atomic_write(self.path(key), value)
+    self.prune()
+
+  def prune(self):
+    'remove least recently used entries until under max_bytes'
+    prune_lru(
+        [x for x in self.directory.iterdir() if x.suffix != '.tmp'],
+        self.max_bytes,
+    )
+
+
+ACTIVE_PROCESSES = set()
+ACTIVE_PROCESSES_LOCK = threading.Lock()
+KILL_GRACE_SECONDS = 5.0
+
+
+def terminate_process(proc, grace=KILL_GRACE_SECONDS):
+  '''
+  SIGTERM a child (its whole process group if it leads one), wait up to grace
+  seconds and then SIGKILL whatever is left
+  '''
+  leads_group = hasattr(os, 'killpg') and getattr(proc, 'new_group', False)
+
+  def send(sig):
+    try:
+      if leads_group:
+        os.killpg(proc.pid, sig)
+      else:
+        proc.send_signal(sig)
+    except (ProcessLookupError, PermissionError):
+      pass
+
+  send(signal.SIGTERM)
+  try:
+    proc.wait(timeout=grace)
+  except subprocess.TimeoutExpired:
+    pass
+  # kill the group even if the leader exited so orphans do not linger
+  if leads_group or proc.poll() is None:
+    send(getattr(signal, 'SIGKILL', signal.SIGTERM))
+  proc.wait()
+
+
+def terminate_all_processes(grace=KILL_GRACE_SECONDS):
+  'terminate every child currently running inside communicate'
+  with ACTIVE_PROCESSES_LOCK:
+    procs = list(ACTIVE_PROCESSES)
+  if procs:
+    logging.warning('terminating %i running commands', len(procs))
+  for proc in procs:
+    terminate_process(proc, grace=grace)
+
+
+atexit.register(terminate_all_processes)
+
+
+def communicate(
+    cmd,
+    cwd=None,
+    env=None,
+    sampler=None,
+    stdout=None,
+    stderr=None,
+    timeout=None,
+    on_line=None,
+):
+  '''
+  run cmd to completion like subprocess.check_call / check_output
+  an optional ResourceSampler follows the process tree of the child
+  with a timeout the child leads a new process group which is terminated
+  as a whole once the timeout passes, subprocess.TimeoutExpired is raised
+  on Ctrl-C every command running in any thread is terminated
+  on_line is called with each line (bytes) of the merged stdout and stderr
+  '''
+  if on_line is not None:
+    stdout, stderr = subprocess.PIPE, subprocess.STDOUT
+
+  def wait(proc):
+    if on_line is None:
+      out, _ = proc.communicate(timeout=timeout)
+      return out
+    wait_streaming(proc, on_line, timeout)
+    return None
+
+  new_group = timeout is not None and os.name == 'posix'
+  with subprocess.Popen(
+      cmd,
+      cwd=cwd,
+      env=env,
+      stdout=stdout,
+      stderr=stderr,
+      start_new_session=new_group,
+  ) as proc:
+    proc.new_group = new_group
+    with ACTIVE_PROCESSES_LOCK:
+      ACTIVE_PROCESSES.add(proc)
+    try:
+      if sampler is None:
+        out = wait(proc)
+      else:
+        sampler.pid = proc.pid
+        with sampler:
+          out = wait(proc)
+
+    except subprocess.TimeoutExpired:
+      logging.error('timed out after %s sec [%s]', timeout,
+                    subprocess.list2cmdline(cmd))
+      terminate_process(proc)
+      raise
+
+    except KeyboardInterrupt:
+      terminate_all_processes()
+      raise
+
+    finally:
+      with ACTIVE_PROCESSES_LOCK:
+        ACTIVE_PROCESSES.discard(proc)
+
+  if proc.returncode:
+    raise subprocess.CalledProcessError(proc.returncode, cmd, output=out)
+  return out
+
+
+def wait_streaming(proc, on_line, timeout=None):
+  '''
+  feed every stdout line of proc to on_line until it exits, a timer thread
+  terminates the process group once timeout seconds pass
+  '''
+  expired = []
+  timer = None
+  if timeout is not None:
+
+    def expire():
+      expired.append(True)
+      terminate_process(proc)
+
+    timer = threading.Timer(timeout, expire)
+    timer.daemon = True
+    timer.start()
+
+  try:
+    for line in proc.stdout:
+      on_line(line)
+    proc.wait()
+  finally:
+    if timer is not None:
+      timer.cancel()
+
+  if expired:
+    raise subprocess.TimeoutExpired(proc.args, timeout)
+
+
 def execute_multiline_str(**kwargs):
   'wraps execute by converting multiline "cmd" kwarg to strings'
   cmd = kwargs.pop('cmd')
@@ -499,7 +871,8 @@ def add_file_logging_parse_arg(parser):
         '--file-log',
         default=None,
         type=Path,
-        help='direct logging stream to this file in addition to stderr',
+        help='direct logging stream to this file in addition to stderr\n'
+        'a .gz suffix writes a gzip compressed log',
     )
     parser.vm_build_utils_has_file_log = True
 
@@ -512,11 +885,108 @@ def set_file_logging_from_args(args):
     args.file_verbose = 0
 
   level = VERBOSE_MAP[args.file_verbose]
-  file_log = logging.FileHandler(args.file_log, mode='w')
+  file_log = BufferedFileHandler(args.file_log, mode='w')
   file_log.setLevel(level)
   file_log.setFormatter(
       logging.Formatter('%(levelname)s %(message)s', None, '%'))
   logging.getLogger('').addHandler(file_log)
+  start_queue_logging()
+
+
+class BufferedFileHandler(logging.StreamHandler):
+  '''
+  file handler that batches writes in a large buffer, flushing at most every
+  flush_interval seconds and on close, a .gz path writes a gzip stream
+  '''
+
+  def __init__(self, path, mode='w', buffer_size=2**16, flush_interval=1.0):
+    path = str(path)
+    if path.endswith('.gz'):
+      stream = io.TextIOWrapper(
+          io.BufferedWriter(gzip.open(path, mode + 'b'), buffer_size),
+          encoding='utf-8',
+      )
+    else:
+      stream = open(path, mode, buffering=buffer_size)
+    super().__init__(stream)
+    self.path = path
+    self.flush_interval = flush_interval
+    self.last_flush = time.monotonic()
+
+  def flush(self):
+    'called after every record, only reaches the file every flush_interval'
+    now = time.monotonic()
+    if now - self.last_flush >= self.flush_interval:
+      self.last_flush = now
+      super().flush()
+
+  def close(self):
+    self.acquire()
+    try:
+      if self.stream is not None:
+        self.stream.flush()
+        self.stream.close()
+        self.stream = None
+    finally:
+      self.release()
+    super().close()
+
+
+LOG_QUEUE = None
+LOG_LISTENER = None
+
+
+def start_queue_logging():
+  '''
+  move the root logger handlers behind a QueueHandler / QueueListener so that
+  logging calls never block on console or file io, stopped at exit
+  '''
+  #pylint: disable=global-statement
+  global LOG_QUEUE, LOG_LISTENER
+  if LOG_LISTENER is not None:
+    return
+
+  root = logging.getLogger('')
+  handlers = list(root.handlers)
+  for handler in handlers:
+    root.removeHandler(handler)
+
+  LOG_QUEUE = queue.Queue()
+  root.addHandler(logging.handlers.QueueHandler(LOG_QUEUE))
+  LOG_LISTENER = logging.handlers.QueueListener(
+      LOG_QUEUE,
+      *handlers,
+      respect_handler_level=True,
+  )
+  LOG_LISTENER.start()
+  # atexit is last in first out: this runs before logging.shutdown
+  atexit.register(stop_queue_logging)
+
+
+def flush_logging():
+  'wait until queued records are written, no-op without queue logging'
+  if LOG_LISTENER is not None:
+    LOG_QUEUE.join()
+
+
+def stop_queue_logging():
+  'drain the queue and hand the handlers back to the root logger'
+  #pylint: disable=global-statement
+  global LOG_QUEUE, LOG_LISTENER
+  if LOG_LISTENER is None:
+    return
+
+  root = logging.getLogger('')
+  for handler in list(root.handlers):
+    if isinstance(handler, logging.handlers.QueueHandler):
+      root.removeHandler(handler)
+
+  LOG_LISTENER.stop()
+  for handler in LOG_LISTENER.handlers:
+    root.addHandler(handler)
+    handler.flush()
+
+  LOG_QUEUE = LOG_LISTENER = None
 
 
 def finish_args(parser):
@@ -568,6 +1038,7 @@ def parse_args(parser, args=None, parse_known_args=False, return_unknown=False):
 
 
 KB = float(10**3)
+KiB = float(2**10)  # 1024
 GB = float(10**9)  # 1000000000
 MiB = float(2**20)  # 1048576
 GiB = float(2**30)  # 1073741824
@@ -606,19 +1077,378 @@ def get_rss_and_total():
   return (get_rss(), total)
 
 
+class GpuMetrics(object):
+  '''
+  gpu metrics provider interface, this base class reports no devices
+  poll() is called from timers and samplers so it must be cheap
+  '''
+
+  def device_count(self):
+    'number of devices reported by poll'
+    return 0
+
+  def poll(self):
+    'list of dict(index, name, used_gb, total_gb, utilization) per device'
+    return []
+
+  def used_and_total(self):
+    'used and total memory in GiB summed over every device'
+    devices = self.poll()
+    used = sum(x['used_gb'] for x in devices)
+    total = sum(x['total_gb'] for x in devices)
+    return used, total
+
+
+class NvmlGpuMetrics(GpuMetrics):
+  'initialises nvml once and caches device handles for cheap polling'
+
+  def __init__(self):
+    pynvml.nvmlInit()
+    count = pynvml.nvmlDeviceGetCount()
+    self.handles = [pynvml.nvmlDeviceGetHandleByIndex(i) for i in range(count)]
+    self.names = []
+    for handle in self.handles:
+      name = pynvml.nvmlDeviceGetName(handle)
+      if isinstance(name, bytes):
+        name = name.decode('utf-8')
+      self.names.append(name)
+
+  def device_count(self):
+    return len(self.handles)
+
+  def poll(self):
+    result = []
+    for index, handle in enumerate(self.handles):
+      mem = pynvml.nvmlDeviceGetMemoryInfo(handle)
+      try:
+        utilization = pynvml.nvmlDeviceGetUtilizationRates(handle).gpu
+      except pynvml.NVMLError:
+        utilization = -1
+      result.append(
+          dict(
+              index=index,
+              name=self.names[index],
+              used_gb=mem.used / GiB,
+              total_gb=mem.total / GiB,
+              utilization=utilization,
+          ))
+    return result
+
+
+class FakeGpuMetrics(GpuMetrics):
+  '''
+  scripted devices so gpu code paths can run on machines without a gpu
+  devices is a list of (used_gb, total_gb) or (used_gb, total_gb, utilization)
+  '''
+
+  def __init__(self, devices=((0.0, 8.0),)):
+    self.devices = [tuple(x) for x in devices]
+    self.poll_count = 0
+
+  def device_count(self):
+    return len(self.devices)
+
+  def poll(self):
+    self.poll_count += 1
+    result = []
+    for index, device in enumerate(self.devices):
+      used, total = device[:2]
+      utilization = device[2] if len(device) > 2 else 0
+      result.append(
+          dict(
+              index=index,
+              name='fake%i' % index,
+              used_gb=used,
+              total_gb=total,
+              utilization=utilization,
+          ))
+    return result
+
+
+GPU_METRICS = None
+
+
+def set_gpu_metrics(provider):
+  'install a GpuMetrics provider, None re-detects on next use'
+  #pylint: disable=global-statement
+  global GPU_METRICS
+  GPU_METRICS = provider
+
+
+def get_gpu_metrics():
+  'lazily create the process wide GpuMetrics provider'
+  #pylint: disable=global-statement
+  global GPU_METRICS
+  if GPU_METRICS is None:
+    provider = GpuMetrics()
+    if pynvml is not None:
+      try:
+        provider = NvmlGpuMetrics()
+      except pynvml.NVMLError as e:
+        logging.debug('nvml unavailable: %s', e)
+    GPU_METRICS = provider
+  return GPU_METRICS
+
+
 def get_gpu_used_and_total():
-  'total physical memory in GB'
-
-  if nvidia_smi is None:
-    return 0, 0
-
-  nvsmi = nvidia_smi.getInstance()
-  qresult = nvsmi.DeviceQuery('memory.used, memory.total')
-  mem = qresult['gpu'][0]['fb_memory_usage']
-  assert mem['unit'] == 'MiB'
-  used = (mem['used'] * MiB) / GiB
-  total = (mem['total'] * MiB) / GiB
-  return used, total
+  'used and total gpu memory in GiB summed over every device'
+  return get_gpu_metrics().used_and_total()
+
+
+def get_load_average():
+  'one minute system load average or -1 if unsupported'
+  try:
+    return os.getloadavg()[0]
+  except (AttributeError, OSError):
+    return -1
+
+
+def get_free_memory():
+  'available physical memory in GB or -1 if unknown'
+  if psutil is not None:
+    return psutil.virtual_memory().available / GB
+
+  if current_platform_is_linux():
+    with open('/proc/meminfo') as fd:
+      for line in fd:
+        if line.startswith('MemAvailable:'):
+          return int(line.split()[1]) * KiB / GB
+
+  try:
+    return (os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')) / GB
+  except (ValueError, OSError):
+    return -1
+
+
+def get_cpu_times():
+  '''
+  cumulative system wide cpu times as (busy, iowait, total)
+  differences between two calls give utilisation over that interval
+  '''
+  if psutil is not None:
+    times = psutil.cpu_times()
+    total = sum(times)
+    iowait = getattr(times, 'iowait', 0)
+    return total - times.idle - iowait, iowait, total
+
+  if current_platform_is_linux():
+    with open('/proc/stat') as fd:
+      fields = [int(x) for x in fd.readline().split()[1:9]]
+    total = sum(fields)
+    idle, iowait = fields[3], fields[4]
+    return total - idle - iowait, iowait, total
+
+  return None
+
+
+def get_process_tree_pids(pid):
+  'pid plus the pids of all of its descendants'
+  if psutil is not None:
+    try:
+      proc = psutil.Process(pid)
+      return [pid] + [x.pid for x in proc.children(recursive=True)]
+    except psutil.NoSuchProcess:
+      return []
+
+  children = {}
+  if current_platform_is_linux():
+    for name in os.listdir('/proc'):
+      if not name.isdigit():
+        continue
+      try:
+        with open('/proc/%s/stat' % name) as fd:
+          stat = fd.read()
+      except OSError:
+        continue
+      # the command name can contain spaces, ppid is after the last ')'
+      ppid = int(stat.rsplit(')', 1)[1].split()[1])
+      children.setdefault(ppid, []).append(int(name))
+  else:
+    ps = subprocess.check_output(['ps', '-A', '-o', 'pid=,ppid='])
+    for line in ps.decode('utf-8').split('\n'):
+      if line.strip():
+        child, ppid = [int(x) for x in line.split()]
+        children.setdefault(ppid, []).append(child)
+
+  result = []
+  todo = [pid]
+  while todo:
+    current = todo.pop()
+    result.append(current)
+    todo.extend(children.get(current, []))
+  return result
+
+
+def get_process_tree_rss(pid):
+  'current resident memory in GB summed over pid and all descendants'
+  pids = get_process_tree_pids(pid)
+
+  rss_bytes = 0
+  if psutil is not None:
+    for tree_pid in pids:
+      try:
+        rss_bytes += psutil.Process(tree_pid).memory_info().rss
+      except psutil.NoSuchProcess:
+        pass
+
+  elif current_platform_is_linux():
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    for tree_pid in pids:
+      try:
+        with open('/proc/%i/statm' % tree_pid) as fd:
+          rss_bytes += int(fd.read().split()[1]) * page_size
+      except OSError:
+        pass
+
+  elif pids:
+    ps_cmd = ['ps', '-o', 'rss=', '-p', ','.join(str(x) for x in pids)]
+    try:
+      ps = subprocess.check_output(ps_cmd)
+    except subprocess.CalledProcessError:
+      ps = b''
+    rss_bytes = sum(int(x) for x in ps.split()) * KiB
+
+  return rss_bytes / GB
+
+
+class ResourceSampler(object):
+  '''
+  background thread polling cpu, load, process tree rss, free memory and gpu
+  samples are written to a .json or .csv (default) timeseries on exit
+    with ResourceSampler('build.csv', interval=0.5, pid=proc.pid):
+      proc.wait()
+  '''
+
+  FIELDS = (
+      'time',
+      'elapsed',
+      'cpu_percent',
+      'iowait_percent',
+      'load_1m',
+      'tree_rss_gb',
+      'free_gb',
+      'gpu_used_gb',
+      'gpu_total_gb',
+      'gpu_utilization',
+  )
+
+  def __init__(self, path=None, interval=1.0, pid=None, gpu=True):
+    self.path = path
+    self.interval = float(interval)
+    self.pid = os.getpid() if pid is None else pid
+    self.gpu = gpu
+    self.samples = []
+    self.start = None
+    self._cpu_times = None
+    self._stop = threading.Event()
+    self._thread = None
+
+  def sample(self):
+    'take one sample, cpu utilisation is relative to the previous sample'
+    now = time.time()
+    if self.start is None:
+      self.start = now
+
+    cpu_percent = iowait_percent = -1
+    cpu_times = get_cpu_times()
+    if cpu_times is not None and self._cpu_times is not None:
+      busy = cpu_times[0] - self._cpu_times[0]
+      iowait = cpu_times[1] - self._cpu_times[1]
+      total = cpu_times[2] - self._cpu_times[2]
+      if total > 0:
+        cpu_percent = 100.0 * busy / total
+        iowait_percent = 100.0 * iowait / total
+    self._cpu_times = cpu_times
+
+    devices = get_gpu_metrics().poll() if self.gpu else []
+    gpu_used = sum(x['used_gb'] for x in devices)
+    gpu_total = sum(x['total_gb'] for x in devices)
+    gpu_utilization = -1
+    if devices:
+      gpu_utilization = sum(x['utilization'] for x in devices) / len(devices)
+
+    result = dict(
+        time=now,
+        elapsed=now - self.start,
+        cpu_percent=cpu_percent,
+        iowait_percent=iowait_percent,
+        load_1m=get_load_average(),
+        tree_rss_gb=get_process_tree_rss(self.pid),
+        free_gb=get_free_memory(),
+        gpu_used_gb=gpu_used,
+        gpu_total_gb=gpu_total,
+        gpu_utilization=gpu_utilization,
+    )
+    self.samples.append(result)
+    return result
+
+  def run(self):
+    'thread body: sample every interval until stopped'
+    while not self._stop.wait(self.interval):
+      try:
+        self.sample()
+      except Exception:  #pylint: disable=broad-except
+        logging.exception('resource sampler failed')
+        return
+
+  def __enter__(self):
+    self.sample()
+    self._stop.clear()
+    self._thread = threading.Thread(
+        target=self.run,
+        name='ResourceSampler',
+        daemon=True,
+    )
+    self._thread.start()
+    return self
+
+  def __exit__(self, *args):
+    self._stop.set()
+    self._thread.join()
+    self.sample()
+    if self.path is not None:
+      self.write(self.path)
+    self.log_summary()
+
+  def peak(self, key):
+    'largest valid value of a field over all samples'
+    values = [x[key] for x in self.samples if x[key] >= 0]
+    return max(values) if values else -1
+
+  def mean(self, key):
+    'average valid value of a field over all samples'
+    values = [x[key] for x in self.samples if x[key] >= 0]
+    return sum(values) / len(values) if values else -1
+
+  def write(self, path):
+    'save samples as json when path ends with .json, otherwise as csv'
+    path = Path(path)
+    with open(path, 'w') as fd:
+      if path.suffix == '.json':
+        json.dump(
+            dict(pid=self.pid, interval=self.interval, samples=self.samples),
+            fd,
+            indent=2,
+        )
+      else:
+        writer = csv.DictWriter(fd, fieldnames=self.FIELDS)
+        writer.writeheader()
+        writer.writerows(self.samples)
+
+  def log_summary(self, level=logging.DEBUG):
+    'one line summary of the timeseries'
+    logging.log(
+        level,
+        'sampled [%s] x%i [cpu %s%%] [iowait %s%%] [peak rss %s GB] '
+        '[min free %s GB] [peak gpu %s GB]',
+        self.path,
+        len(self.samples),
+        yellow_text('%.1f' % self.mean('cpu_percent')),
+        yellow_text('%.1f' % self.mean('iowait_percent')),
+        yellow_text('%.2f' % self.peak('tree_rss_gb')),
+        yellow_text('%.2f' % min(x['free_gb'] for x in self.samples)),
+        yellow_text('%.2f' % self.peak('gpu_used_gb')),
+    )
 
 
 class T(object):
@@ -6,32 +6,315 @@ list information for git submodules
 '''
 from __future__ import print_function
 import os
+import stat
 import json
+import logging
+import argparse
+import tempfile
+import threading
+import functools
+import zlib
+import struct
 import datetime
 import subprocess
+import concurrent.futures
 
+# absolute so the script still runs standalone, without the command cache
+try:
+  from vm_build_utils import cmd
+except ImportError:
+  cmd = None
 
-def get_module_info(path):
-  'return branch and commit for a git repo or submodule'
-  path = str(path)
-  branch = subprocess.check_output(
+
+class GitReadError(Exception):
+  'repository layout the pure python reader does not handle'
+
+
+def locate_git_dirs(path):
+  '''
+  (git_dir, common_dir) for a work tree root, following the "gitdir:" file
+  used by submodules and the commondir file used by linked worktrees
+  '''
+  git_dir = os.path.join(path, '.git')
+  if os.path.isfile(git_dir):
+    with open(git_dir) as fd:
+      line = fd.read().strip()
+    if not line.startswith('gitdir:'):
+      raise GitReadError('unexpected .git file in %s' % path)
+    git_dir = os.path.join(path, line[len('gitdir:'):].strip())
+  if not os.path.isdir(git_dir):
+    raise GitReadError('no .git directory in %s' % path)
+
+  common_dir = git_dir
+  commondir_path = os.path.join(git_dir, 'commondir')
+  if os.path.exists(commondir_path):
+    with open(commondir_path) as fd:
+      common_dir = os.path.join(git_dir, fd.read().strip())
+
+  return os.path.normpath(git_dir), os.path.normpath(common_dir)
+
+
+def find_git_dirs(path):
+  'locate_git_dirs for layouts the pure python reader handles'
+  git_dir, common_dir = locate_git_dirs(path)
+
+  if os.path.exists(os.path.join(common_dir, 'reftable')):
+    raise GitReadError('reftable refs in %s' % common_dir)
+
+  return git_dir, common_dir
+
+
+def read_packed_refs(common_dir):
+  'dict of ref name to sha from packed-refs'
+  result = {}
+  try:
+    with open(os.path.join(common_dir, 'packed-refs')) as fd:
+      for line in fd:
+        if line.startswith('#') or line.startswith('^'):
+          continue
+        parts = line.split()
+        if len(parts) == 2:
+          result[parts[1]] = parts[0]
+  except FileNotFoundError:
+    pass
+  return result
+
+
+def read_ref(git_dir, common_dir, ref, packed_refs=None, depth=0):
+  'resolve a possibly symbolic ref such as HEAD or refs/heads/x to a sha'
+  if depth > 5:
+    raise GitReadError('symbolic ref loop at %s' % ref)
+
+  # HEAD and other pseudo refs are per worktree, everything else is shared
+  base = git_dir if '/' not in ref else common_dir
+  try:
+    with open(os.path.join(base, ref)) as fd:
+      value = fd.read().strip()
+  except (FileNotFoundError, NotADirectoryError, IsADirectoryError):
+    value = None
+
+  if value is None:
+    if packed_refs is None:
+      packed_refs = read_packed_refs(common_dir)
+    if ref not in packed_refs:
+      raise GitReadError('unresolved ref %s' % ref)
+    value = packed_refs[ref]
+
+  if value.startswith('ref:'):
+    target = value[len('ref:'):].strip()
+    return read_ref(git_dir, common_dir, target, packed_refs, depth + 1)
+
+  if len(value) != 40:
+    raise GitReadError('unsupported object id %s' % value)
+  return value
+
+
+def read_pack_object(common_dir, sha):
+  '''
+  (type, body) for an undeltified object found through a v2 pack index
+  None if the object is in no pack
+  '''
+  pack_dir = os.path.join(common_dir, 'objects', 'pack')
+  try:
+    idx_names = [x for x in os.listdir(pack_dir) if x.endswith('.idx')]
+  except FileNotFoundError:
+    return None
+
+  binary_sha = bytes.fromhex(sha)
+  first = binary_sha[0]
+
+  for idx_name in idx_names:
+    idx_path = os.path.join(pack_dir, idx_name)
+    with open(idx_path, 'rb') as fd:
+      header = fd.read(8)
+      if header[:4] != b'\377tOc' or struct.unpack('>I', header[4:])[0] != 2:
+        raise GitReadError('unsupported pack index %s' % idx_path)
+      fanout = struct.unpack('>256I', fd.read(1024))
+      count = fanout[255]
+      lo = fanout[first - 1] if first else 0
+      hi = fanout[first]
+      shas_start = 8 + 1024
+      position = None
+      while lo < hi:
+        mid = (lo + hi) // 2
+        fd.seek(shas_start + 20 * mid)
+        value = fd.read(20)
+        if value == binary_sha:
+          position = mid
+          break
+        if value < binary_sha:
+          lo = mid + 1
+        else:
+          hi = mid
+      if position is None:
+        continue
+
+      offsets_start = shas_start + 24 * count
+      fd.seek(offsets_start + 4 * position)
+      offset = struct.unpack('>I', fd.read(4))[0]
+      if offset & 0x80000000:
+        fd.seek(offsets_start + 4 * count + 8 * (offset & 0x7fffffff))
+        offset = struct.unpack('>Q', fd.read(8))[0]
+
+    pack_path = idx_path[:-len('.idx')] + '.pack'
+    with open(pack_path, 'rb') as fd:
+      fd.seek(offset)
+      byte = fd.read(1)[0]
+      obj_type = (byte >> 4) & 7
+      while byte & 0x80:
+        byte = fd.read(1)[0]
+      if obj_type not in (1, 2, 3, 4):
+        raise GitReadError('deltified object %s' % sha)
+
+      decompress = zlib.decompressobj()
+      body = b''
+      while not decompress.eof:
+        chunk = fd.read(4096)
+        if not chunk:
+          break
+        body += decompress.decompress(chunk)
+
+    type_names = {1: 'commit', 2: 'tree', 3: 'blob', 4: 'tag'}
+    return type_names[obj_type], body
+
+  return None
+
+
+def read_object(common_dir, sha):
+  '(type, body) of a loose or packed undeltified object'
+  loose_path = os.path.join(common_dir, 'objects', sha[:2], sha[2:])
+  try:
+    with open(loose_path, 'rb') as fd:
+      raw = zlib.decompress(fd.read())
+  except FileNotFoundError:
+    result = read_pack_object(common_dir, sha)
+    if result is None:
+      raise GitReadError('object %s not found' % sha)
+    return result
+
+  header, body = raw.split(b'\0', 1)
+  return header.split(b' ')[0].decode('utf-8'), body
+
+
+def commit_date(body):
+  'committer date of a raw commit formatted like git show --format=%ci'
+  for line in body.split(b'\n'):
+    if not line:
+      break
+    if line.startswith(b'committer '):
+      timestamp, tz = line.rsplit(b' ', 2)[1:]
+      tz = tz.decode('utf-8')
+      minutes = int(tz[1:3]) * 60 + int(tz[3:5])
+      if tz[0] == '-':
+        minutes = -minutes
+      tzinfo = datetime.timezone(datetime.timedelta(minutes=minutes))
+      date = datetime.datetime.fromtimestamp(int(timestamp), tzinfo)
+      return date.strftime('%Y-%m-%d %H:%M:%S ') + tz
+  raise GitReadError('commit without committer')
+
+
+def read_head_info(path):
+  '''
+  (branch, commit, date) read directly from the files in .git
+  raises GitReadError for layouts that need the git cli
+  '''
+  git_dir, common_dir = find_git_dirs(path)
+
+  with open(os.path.join(git_dir, 'HEAD')) as fd:
+    head = fd.read().strip()
+
+  packed_refs = read_packed_refs(common_dir)
+  branch = 'HEAD'
+  if head.startswith('ref:'):
+    ref = head[len('ref:'):].strip()
+    if not ref.startswith('refs/heads/'):
+      raise GitReadError('HEAD points outside refs/heads: %s' % ref)
+    branch = ref[len('refs/heads/'):]
+    # git abbreviates to heads/x when another ref shares the short name
+    for other in (
+        'refs/' + branch,
+        'refs/tags/' + branch,
+        'refs/remotes/' + branch,
+        'refs/remotes/' + branch + '/HEAD',
+    ):
+      if other in packed_refs or os.path.isfile(os.path.join(
+          common_dir, other)):
+        raise GitReadError('ambiguous branch name %s' % branch)
+
+  commit = read_ref(git_dir, common_dir, 'HEAD', packed_refs)
+
+  obj_type, body = read_object(common_dir, commit)
+  if obj_type != 'commit':
+    raise GitReadError('HEAD is not a commit')
+
+  return branch, commit, commit_date(body)
+
+
+def head_inputs(path):
+  '''
+  files whose stat changes whenever HEAD, the branch it names or any ref
+  moves, including reftable repositories. [] if there is no git directory
+  '''
+  try:
+    git_dir, common_dir = locate_git_dirs(path)
+  except GitReadError:
+    return []
+  head_path = os.path.join(git_dir, 'HEAD')
+  inputs = [
+      head_path,
+      os.path.join(common_dir, 'packed-refs'),
+      os.path.join(common_dir, 'reftable', 'tables.list'),
+  ]
+  try:
+    with open(head_path) as fd:
+      head = fd.read().strip()
+  except OSError:
+    return []
+  if head.startswith('ref:'):
+    inputs.append(os.path.join(common_dir, head[len('ref:'):].strip()))
+  return inputs
+
+
+def git_output(args, path, inputs):
+  '''
+  stdout of a read only git command, from the cmd.CommandCache while the
+  inputs are unchanged when vm_build_utils is importable
+  '''
+  if cmd is None or not inputs:
+    return subprocess.check_output(args, cwd=path)
+  return cmd.execute(
+      args,
+      cwd=path,
+      output=True,
+      cache=cmd.CommandCache(),
+      cache_env=('GIT_DIR', 'GIT_WORK_TREE', 'GIT_COMMON_DIR'),
+      cache_inputs=inputs,
+  )
+
+
+def git_head_info(path):
+  '(branch, commit, date) using the git cli'
+  inputs = head_inputs(path)
+  branch = git_output(
       [
           'git',
           'rev-parse',
           '--abbrev-ref',
           'HEAD',
       ],
-      cwd=path,
+      path,
+      inputs,
   ).decode('utf-8').strip()
-  commit = subprocess.check_output(
+  commit = git_output(
       [
           'git',
           'rev-parse',
           'HEAD',
       ],
-      cwd=path,
+      path,
+      inputs,
   ).decode('utf-8').strip()
-  date = subprocess.check_output(
+  date = git_output(
       [
           'git',
           'show',
@@ -39,8 +322,205 @@ def get_module_info(path):
           '--format=%ci',
           commit,
       ],
-      cwd=path,
+      path,
+      inputs,
   ).decode('utf-8').strip()
+  return branch, commit, date
+
+
+GITLINK_MODE = 0o160000
+SYMLINK_MODE = 0o120000
+DIRTY_MODES = ('stat', 'diff', 'refresh', 'never')
+
+
+def read_index_entries(git_dir):
+  '''
+  list of (path, ctime_s, ctime_ns, mtime_s, mtime_ns, ino, size, mode, sha,
+  stage, skip_worktree) for each entry of a version 2, 3 or 4 index
+  raises GitReadError for split or sparse indexes, whose entries are only a
+  partial set, before any entry is returned
+  '''
+  with open(os.path.join(git_dir, 'index'), 'rb') as fd:
+    data = fd.read()
+
+  signature, version, count = struct.unpack('>4sII', data[:12])
+  if signature != b'DIRC' or version not in (2, 3, 4):
+    raise GitReadError('unsupported index version %s' % version)
+
+  entry = struct.Struct('>10I20sH')
+  entries = []
+  pos = 12
+  path = b''
+  for _ in range(count):
+    start = pos
+    fields = entry.unpack_from(data, pos)
+    pos += entry.size
+    flags = fields[11]
+    skip_worktree = False
+    if flags & 0x4000:
+      extended = struct.unpack_from('>H', data, pos)[0]
+      skip_worktree = bool(extended & 0x4000)
+      pos += 2
+
+    if version == 4:
+      byte = data[pos]
+      pos += 1
+      strip = byte & 127
+      while byte & 128:
+        byte = data[pos]
+        pos += 1
+        strip = ((strip + 1) << 7) + (byte & 127)
+      end = data.index(b'\0', pos)
+      path = path[:len(path) - strip] + data[pos:end]
+      pos = end + 1
+    else:
+      end = data.index(b'\0', pos)
+      path = data[pos:end]
+      # entries are NUL padded to a multiple of 8 bytes
+      pos = start + ((end - start) // 8 + 1) * 8
+
+    entries.append((
+        path.decode('utf-8', 'surrogateescape'),
+        fields[0],
+        fields[1],
+        fields[2],
+        fields[3],
+        fields[5],
+        fields[9],
+        fields[6],
+        fields[10].hex(),
+        (flags >> 12) & 3,
+        skip_worktree,
+    ))
+
+  while pos < len(data) - 20:
+    name, size = struct.unpack_from('>4sI', data, pos)
+    if name in (b'link', b'sdir'):
+      raise GitReadError('split or sparse index in %s' % git_dir)
+    pos += 8 + size
+
+  return entries
+
+
+def read_core_config(common_dir):
+  '''
+  dict of lower case [core] keys to values from the repository config
+  None when the config has includes or fsmonitor, which only git can resolve
+  '''
+  with open(os.path.join(common_dir, 'config'), 'rb') as fd:
+    data = fd.read().decode('utf-8', 'surrogateescape')
+  if 'include' in data or 'fsmonitor' in data:
+    return None
+
+  core = {}
+  section = None
+  for line in data.splitlines():
+    line = line.split('#', 1)[0].split(';', 1)[0].strip()
+    if line.startswith('['):
+      section = line.strip('[]').strip().lower()
+    elif section == 'core' and line:
+      key, _, value = line.partition('=')
+      core[key.strip().lower()] = value.strip().lower() if _ else 'true'
+  return core
+
+
+def config_bool(value, default):
+  'git config boolean value, default when unset'
+  if value is None:
+    return default
+  return value in ('true', 'yes', 'on', '1')
+
+
+def worktree_mode(st, index_mode, file_mode, symlinks):
+  '''
+  index mode git would record for a stat result, None if it is neither a
+  symlink nor a regular file. like git, the exec bit keeps its index value
+  when core.fileMode is off and symlinks checked out as plain files when
+  core.symlinks is off stay symlinks
+  '''
+  if stat.S_ISLNK(st.st_mode):
+    return SYMLINK_MODE
+  if not stat.S_ISREG(st.st_mode):
+    return None
+  if index_mode == SYMLINK_MODE and not symlinks:
+    return SYMLINK_MODE
+  if not file_mode and index_mode in (0o100644, 0o100755):
+    return index_mode
+  return 0o100755 if st.st_mode & 0o100 else 0o100644
+
+
+def stat_dirty(path):
+  '''
+  compare index stat data against the work tree without writing the index
+  returns True (dirty), False (clean) or None when git has to decide
+  stops at the first modified entry. submodules are ignored like
+  update-index --ignore-submodules does
+  '''
+  git_dir, common_dir = find_git_dirs(path)
+
+  core = read_core_config(common_dir)
+  if core is None:
+    return None
+  if config_bool(core.get('splitindex'), False):
+    return None
+  file_mode = config_bool(core.get('filemode'), True)
+  symlinks = config_bool(core.get('symlinks'), True)
+
+  index_mtime = os.stat(os.path.join(git_dir, 'index')).st_mtime_ns
+
+  for entry in read_index_entries(git_dir):
+    (rel_path, ctime_s, ctime_ns, mtime_s, mtime_ns, ino, size, mode, _, stage,
+     skip) = entry
+    if stage:
+      return True
+    if skip or mode == GITLINK_MODE:
+      continue
+    try:
+      st = os.lstat(os.path.join(path, rel_path))
+    except FileNotFoundError:
+      return True
+
+    if worktree_mode(st, mode, file_mode, symlinks) != mode:
+      return True
+
+    if st.st_size & 0xffffffff != size:
+      return True
+    if int(st.st_mtime) != mtime_s or (mtime_ns and
+                                       st.st_mtime_ns % 10**9 != mtime_ns):
+      return None
+    if int(st.st_ctime) != ctime_s or (ctime_ns and
+                                       st.st_ctime_ns % 10**9 != ctime_ns):
+      return None
+    if ino and st.st_ino & 0xffffffff != ino:
+      return None
+    # racily clean: modified in the same instant the index was written
+    if st.st_mtime_ns >= index_mtime:
+      return None
+  return False
+
+
+def git_diff_dirty(path):
+  '''
+  ask git, without taking the index lock, if the work tree differs
+  submodules are ignored like update-index --ignore-submodules does
+  '''
+  returncode = subprocess.call(
+      [
+          'git',
+          '--no-optional-locks',
+          'diff',
+          '--quiet',
+          '--ignore-submodules',
+      ],
+      cwd=path,
+  )
+  if returncode not in (0, 1):
+    raise subprocess.CalledProcessError(returncode, 'git diff')
+  return returncode == 1
+
+
+def git_refresh_dirty(path):
+  'original check: git update-index --refresh, which rewrites the index'
   try:
     subprocess.check_call(
         [
@@ -52,6 +532,179 @@ def get_module_info(path):
         cwd=path,
     )
   except subprocess.CalledProcessError:
+    return True
+  return False
+
+
+def is_dirty(path, mode='stat'):
+  '''
+  True if tracked files differ from the index, submodules are ignored
+    stat: index stat data first, git diff only when stat data is inconclusive
+    diff: git diff --quiet, uses fsmonitor / untracked cache when configured
+    refresh: git update-index --refresh, writes the index
+    never: skip the check and report clean
+  '''
+  if mode == 'never':
+    return False
+  if mode == 'refresh':
+    return git_refresh_dirty(path)
+  if mode == 'stat':
+    try:
+      result = stat_dirty(path)
+    except (GitReadError, OSError, ValueError, struct.error):
+      result = None
+    if result is not None:
+      return result
+  elif mode != 'diff':
+    raise ValueError('dirty mode must be one of %s' % (DIRTY_MODES,))
+  return git_diff_dirty(path)
+
+
+def file_state(path):
+  '[mtime_ns, size] of a file or None if it does not exist'
+  try:
+    st = os.stat(path)
+  except FileNotFoundError:
+    return None
+  return [st.st_mtime_ns, st.st_size]
+
+
+def repo_state(path):
+  '''
+  json friendly summary of the files that decide branch and commit:
+  HEAD and the ref it points to, packed-refs and the index
+  '''
+  git_dir, common_dir = find_git_dirs(path)
+  with open(os.path.join(git_dir, 'HEAD')) as fd:
+    head = fd.read().strip()
+
+  ref_value = None
+  if head.startswith('ref:'):
+    try:
+      with open(os.path.join(common_dir, head[len('ref:'):].strip())) as fd:
+        ref_value = fd.read().strip()
+    except FileNotFoundError:
+      pass
+
+  return [
+      head,
+      ref_value,
+      file_state(os.path.join(common_dir, 'packed-refs')),
+      file_state(os.path.join(git_dir, 'index')),
+  ]
+
+
+def submodule_state(path):
+  'repo_state plus the files that decide which submodules are checked out'
+  git_dir, _ = find_git_dirs(path)
+  return repo_state(path) + [
+      file_state(os.path.join(path, '.gitmodules')),
+      file_state(os.path.join(git_dir, 'config')),
+  ]
+
+
+class ModuleInfoCache(object):
+  '''
+  on disk cache of head info and submodule lists keyed by repository state
+  entries are reused only while every key file is unchanged
+  '''
+
+  VERSION = 1
+
+  def __init__(self, path):
+    self.path = str(path)
+    self.hits = self.misses = 0
+    self.entries = {}
+    self.changed = False
+    self.lock = threading.Lock()
+    try:
+      with open(self.path) as fd:
+        data = json.load(fd)
+      if data.get('version') == self.VERSION:
+        self.entries = data['entries']
+    except (FileNotFoundError, ValueError, KeyError):
+      pass
+
+  @staticmethod
+  def for_repo(root_path):
+    'cache stored inside the git directory of root_path or None'
+    try:
+      git_dir, _ = find_git_dirs(str(root_path))
+    except GitReadError:
+      return None
+    return ModuleInfoCache(
+        os.path.join(git_dir, 'vm_build_utils', 'module_info.json'))
+
+  def lookup(self, name, key, compute):
+    'cached value for name if stored with an equal key, else compute + store'
+    with self.lock:
+      entry = self.entries.get(name)
+      if entry is not None and entry['key'] == key:
+        self.hits += 1
+        return entry['value']
+      self.misses += 1
+
+    value = compute()
+    self.store(name, key, value)
+    return value
+
+  def store(self, name, key, value):
+    'remember value for name while key stays the same'
+    with self.lock:
+      self.entries[name] = dict(key=key, value=value)
+      self.changed = True
+
+  def save(self):
+    'atomically rewrite the cache file if anything changed'
+    if not self.changed:
+      return
+    # this script runs standalone, so it cannot use cmd.atomic_write
+    directory = os.path.dirname(self.path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'w') as tmp:
+      json.dump(dict(version=self.VERSION, entries=self.entries), tmp)
+    os.replace(tmp_path, self.path)
+    self.changed = False
+
+
+def get_head_info(path, fast=True):
+  '(branch, commit, date) from .git directly, or the git cli if needed'
+  if fast:
+    try:
+      return read_head_info(path)
+    except (GitReadError, OSError, ValueError, zlib.error):
+      pass
+  return git_head_info(path)
+
+
+def get_module_info(path, fast=True, dirty='stat', cache=None):
+  '''
+  return branch and commit for a git repo or submodule
+  fast reads .git directly and only uses the git cli for unusual layouts
+  dirty selects how "-dirty" is detected, see is_dirty
+  cache is an optional ModuleInfoCache, dirtiness is never cached
+  '''
+  path = str(path)
+
+  key = None
+  if cache is not None:
+    try:
+      key = repo_state(path)
+    except (GitReadError, OSError):
+      key = None
+
+  if key is None:
+    head_info = get_head_info(path, fast)
+  else:
+    head_info = cache.lookup(
+        'head:' + path,
+        key,
+        lambda: list(get_head_info(path, fast)),
+    )
+  branch, commit, date = head_info
+
+  if is_dirty(path, dirty):
     commit += '-dirty'
 
   return dict(
@@ -64,29 +717,97 @@ def get_module_info(path):
   )
 
 
-def get_all_module_info(root_path):
-  'return a dictionary of branch, commit for repo and submodules'
-  root_path = str(root_path)
+def list_submodule_paths(root_path):
+  '''
+  absolute paths of every checked out submodule, recursively, in the order
+  git submodule foreach --recursive visits them
+  '''
+  root_path = os.path.abspath(str(root_path))
   r = subprocess.check_output(
       [
           'git',
           'submodule',
-          '--quiet',
-          'foreach',
+          'status',
           '--recursive',
-          'echo `pwd`',
       ],
       cwd=root_path,
   )
-  info = get_module_info(root_path)
-  result = {}
-  result[info['name']] = info
 
-  for path in r.decode('utf-8').split('\n'):
-    if path == '':
+  result = []
+  for line in r.decode('utf-8').split('\n'):
+    # <state><sha> <path>[ (<describe>)], state "-" is not checked out
+    if len(line) < 43 or line[0] == '-':
       continue
-    info = get_module_info(path)
-    result[info['name']] = info
+    path = line[42:]
+    if path.endswith(')') and ' (' in path:
+      path = path.rsplit(' (', 1)[0]
+    result.append(os.path.join(root_path, path))
+  return result
+
+
+def cached_submodule_paths(root_path, cache):
+  'list_submodule_paths, reused while no repo in the tree has moved'
+  name = 'submodules:' + os.path.abspath(root_path)
+
+  def state(paths):
+    return [submodule_state(x) for x in [root_path] + paths]
+
+  entry = cache.entries.get(name)
+  if entry is not None:
+    try:
+      if state(entry['value']) == entry['key']:
+        cache.hits += 1
+        return entry['value']
+    except (GitReadError, OSError):
+      pass
+
+  cache.misses += 1
+  paths = list_submodule_paths(root_path)
+  cache.store(name, state(paths), paths)
+  return paths
+
+
+def get_all_module_info(root_path, jobs=None, dirty='stat', cache=True):
+  '''
+  return a dictionary of branch, commit for repo and submodules
+  submodules are inspected concurrently on up to jobs threads
+  dirty selects how "-dirty" is detected, see is_dirty
+  cache is True for a ModuleInfoCache inside the root git directory,
+    False / None to always ask git, or a ModuleInfoCache instance
+  '''
+  root_path = str(root_path)
+
+  if cache is True:
+    cache = ModuleInfoCache.for_repo(root_path)
+  if not cache:
+    cache = None
+
+  if cache is None:
+    paths = list_submodule_paths(root_path)
+  else:
+    try:
+      paths = cached_submodule_paths(root_path, cache)
+    except (GitReadError, OSError):
+      paths = list_submodule_paths(root_path)
+
+  result = {}
+  with concurrent.futures.ThreadPoolExecutor(
+      max_workers=jobs or min(32, len(paths) + 1)) as executor:
+    infos = executor.map(
+        functools.partial(get_module_info, dirty=dirty, cache=cache),
+        [root_path] + paths,
+    )
+    for info in infos:
+      result[info['name']] = info
+
+  if cache is not None:
+    cache.save()
+    logging.info(
+        'module info cache [%s] hits [%i] misses [%i]',
+        cache.path,
+        cache.hits,
+        cache.misses,
+    )
 
   filter_names = {}
   for name, info in result.items():
@@ -94,9 +815,39 @@ def get_all_module_info(root_path):
   return filter_names
 
 
+def build_parser():
+  'returns a parser (can be used by the tool below or by sphinx)'
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument(
+      '--dirty',
+      help='how to detect modified work trees, see is_dirty',
+      choices=DIRTY_MODES,
+      default='stat',
+  )
+  parser.add_argument(
+      '--no-cache',
+      help='always query git instead of reusing cached module info',
+      action='store_true',
+  )
+  parser.add_argument(
+      '-v',
+      '--verbose',
+      help='log cache hit and miss counts',
+      action='store_true',
+  )
+  return parser
+
+
 def main():
   'print module info to stdout as json'
-  result = get_all_module_info(os.getcwd())
+  args = build_parser().parse_args()
+  if args.verbose:
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+  result = get_all_module_info(
+      os.getcwd(),
+      dirty=args.dirty,
+      cache=not args.no_cache,
+  )
   print(json.dumps(result, indent=2, sort_keys=True))
 
 
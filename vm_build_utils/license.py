@@ -7,6 +7,14 @@ find source files and apply a license header
 import os
 import sys
 import argparse
+import concurrent.futures
+
+# longest shebang line scan_file() reads past before falling back to a full
+# process_file()
+SHEBANG_LIMIT = 256
+
+# per extension (header, replace_headers), set in scanner processes
+SCAN_VARIANTS = {}
 
 
 def build_parser():
@@ -61,11 +69,18 @@ def build_parser():
       choices=['print', 'execute'],
   )
 
+  AP.add_argument(
+      '--jobs',
+      help='number of processes scanning files for existing headers',
+      type=int,
+      default=os.cpu_count(),
+  )
+
   return AP
 
 
-def process_file(ext, path, header, relpace_headers, execute):
-  'add a header to a file, possibly changing # style comments to //'
+def header_variants(ext, header, relpace_headers):
+  'header and replace headers in the comment style of a file extension'
   if ext in ('.md', '.rst'):
     header = header.replace('#', '')
     relpace_headers = [x.replace('#', '') for x in relpace_headers]
@@ -74,6 +89,71 @@ def process_file(ext, path, header, relpace_headers, execute):
   elif ext not in ('.py', '.sh', '.txt', '.yml', '.cmake'):
     header = header.replace('#', '//')
     relpace_headers = [x.replace('#', '//') for x in relpace_headers]
+  return header, relpace_headers
+
+
+def init_scanner(variants):
+  'process pool initializer, variants are shared by every scan_file() call'
+  SCAN_VARIANTS.clear()
+  SCAN_VARIANTS.update(variants)
+
+
+def scan_file(item):
+  '''
+  (needs_processing, messages) for an (ext, path) item
+  only the leading characters that can hold a shebang, the replace headers
+  and the header are read. files that already start with the header are
+  settled here with the messages process_file() would print, anything else
+  is left for a full process_file()
+  '''
+  ext, path = item
+  header, relpace_headers = SCAN_VARIANTS[ext]
+  limit = len(header) + sum(len(x) for x in relpace_headers)
+
+  with open(path) as fd:
+    lines = fd.read(limit + SHEBANG_LIMIT)
+  complete = len(lines) < limit + SHEBANG_LIMIT
+
+  if lines.startswith('#!'):
+    if '\n' not in lines:
+      return True, []
+    lines = lines.split('\n', 1)[1]
+  if not complete and len(lines) < limit:
+    return True, []
+
+  messages = []
+  for relpace_header in relpace_headers:
+    if lines.startswith(relpace_header):
+      messages.append('replacing ' + path)
+      lines = lines[len(relpace_header):]
+
+  if lines.startswith(header):
+    messages.append('skipping ' + path)
+    return False, messages
+
+  return True, []
+
+
+def scan_files(items, variants, jobs):
+  '''
+  scan_file() every item, on a pool of jobs processes when there is more than
+  one job, results are in item order
+  '''
+  if jobs is not None and jobs <= 1:
+    init_scanner(variants)
+    return [scan_file(item) for item in items]
+
+  with concurrent.futures.ProcessPoolExecutor(
+      max_workers=jobs,
+      initializer=init_scanner,
+      initargs=(variants,),
+  ) as executor:
+    return list(executor.map(scan_file, items, chunksize=64))
+
+
+def process_file(ext, path, header, relpace_headers, execute):
+  'add a header to a file, possibly changing # style comments to //'
+  header, relpace_headers = header_variants(ext, header, relpace_headers)
 
   with open(path) as fd:
     lines = fd.read()
@@ -114,7 +194,7 @@ def main():
     header = fd.read()
 
   replace_headers = []
-  for rl in args.replace_licenses:
+  for rl in args.replace_licenses or []:
     with open(rl) as fd:
       replace_headers.append(fd.read())
 
@@ -148,15 +228,20 @@ def main():
 
       items.append((ext, file_path))
 
-  if args.action == 'print':
-    for ext, path in items:
-      print('\n\n\n' + path)
-      process_file(ext, path, header, replace_headers, False)
+  if args.action in ('print', 'execute'):
+    # cheap bounded scans in parallel, full reads only where a header is due
+    variants = dict(
+        (ext, header_variants(ext, header, replace_headers)) for ext in exts)
+    scans = scan_files(items, variants, args.jobs)
 
-  elif args.action == 'execute':
-    for ext, path in items:
+    for (ext, path), (needs_processing, messages) in zip(items, scans):
       print('\n\n\n' + path)
-      process_file(ext, path, header, replace_headers, True)
+      if needs_processing:
+        process_file(ext, path, header, replace_headers,
+                     args.action == 'execute')
+      else:
+        for message in messages:
+          print(message)
   # if args.action == 'execute':
   # for path in paths:
   # print(path)
@@ -5,15 +5,50 @@
 build icon png files of various sizes in XCode retina icon format
 '''
 import os
+import collections
+import functools
+import concurrent.futures
 import json
+import hashlib
+import io
 import logging
+import shutil
+import struct
+import time
 import argparse
 import subprocess
+import zlib
 
-try:
-  import cv2
-except ImportError:
-  logging.warning('cannot import cv2')
+# per iconset record of inputs and output hashes, see build_iconset()
+MANIFEST_NAME = '.retina_icons.json'
+
+# png encoding profiles: zlib level and cv2 strategy (None keeps the cv2
+# default) and whether ancillary chunks are stripped. fast pins the lowest
+# compressing zlib level with run length matching, which suits the white
+# padding, for iterative dev builds. release trades a lot of encode time
+# (seconds per large image) for the smallest app bundle
+PNG_PROFILES = {
+    'default': dict(level=None, strategy=None, strip=False),
+    'fast': dict(level=1, strategy='IMWRITE_PNG_STRATEGY_RLE', strip=False),
+    'release': dict(level=9, strategy='IMWRITE_PNG_STRATEGY_FILTERED',
+                    strip=True),
+}
+
+# opencv and numpy are imported on first use by import_cv2() and
+# import_numpy() so that metadata only paths like --get-outputs never load
+# them. without opencv the numpy engine resizes, pads and encodes
+cv2 = None
+np = None
+
+
+def import_cv2():
+  'import opencv into this module on first use'
+  #pylint: disable=global-statement,invalid-name
+  global cv2
+  if cv2 is None:
+    #pylint: disable=import-outside-toplevel,redefined-outer-name
+    import cv2
+  return cv2
 
 
 def default_iconset_contents_json():
@@ -260,13 +295,20 @@ def build_parser():
 
   parser.add_argument(
       '--iconset',
-      help='name of the iconset to generate',
+      help='name of the iconset(s) to generate',
+      nargs='+',
   )
 
   parser.add_argument(
       '--src',
-      help='path to src image',
-      required=True,
+      help='path to src image, either one for all iconsets or one per iconset',
+      nargs='+',
+  )
+
+  parser.add_argument(
+      '--manifest',
+      help='json list of {"iconset", "src", "pad_mode"} entries to build in\n'
+      'one process, each distinct src image is decoded once',
   )
 
   parser.add_argument(
@@ -301,20 +343,709 @@ def build_parser():
       choices=['pad', 'copy'],
   )
 
+  parser.add_argument(
+      '--pyramid',
+      help='resize small outputs from progressively halved copies of src',
+      action='store_true',
+  )
+
+  parser.add_argument(
+      '--profile',
+      help='png encoding profile, fast for dev builds, release for bundles',
+      default='default',
+      choices=sorted(PNG_PROFILES),
+  )
+
+  parser.add_argument(
+      '--quantize-bits',
+      help='posterize outputs to this many bits per channel before encoding',
+      type=int,
+      choices=range(1, 8),
+  )
+
+  parser.add_argument(
+      '--engine',
+      help='image library, auto uses cv2 when installed and numpy otherwise',
+      default='auto',
+      choices=['auto', 'cv2', 'numpy'],
+  )
+
+  parser.add_argument(
+      '-j',
+      '--jobs',
+      help='resize, pad and encode this many outputs in parallel',
+      type=int,
+      default=1,
+  )
+
   return parser
 
 
-def read_rgb8_image_cv2(path):
-  'read 8bit rgb image using opencv'
-  img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+def imread_flags(flags):
+  'cv2.imread flag value of | separated cv2.IMREAD_* constant names'
+  import_cv2()
+  value = 0
+  for name in flags.split('|'):
+    value |= getattr(cv2, name.strip())
+  return value
+
+
+def read_rgb8_image_cv2(path, flags='IMREAD_UNCHANGED'):
+  'read 8bit rgb image using opencv, flags are | separated cv2.IMREAD_* names'
+  import_cv2()
+  img = cv2.imread(path, imread_flags(flags))
   return img
 
 
 def write_rgb8_image_cv2(img, path):
   'write 8bit rgb image using opencv'
+  import_cv2()
   cv2.imwrite(path, img)
 
 
+def quantize_image(img, bits):
+  'posterize every channel to bits significant bits, stretched back to 0..255'
+  levels = float((1 << bits) - 1)
+  quantized = (img.astype('float32') * (levels / 255.0)).round()
+  return (quantized * (255.0 / levels)).round().astype(img.dtype)
+
+
+def strip_png_chunks(data):
+  'drop ancillary png chunks (text, time, exif, icc ...) except tRNS'
+  chunks = [PNG_SIGNATURE]
+  offset = len(PNG_SIGNATURE)
+  while offset < len(data):
+    length, chunk_type = struct.unpack('>I4s', data[offset:offset + 8])
+    end = offset + 12 + length
+    if chunk_type[0:1].isupper() or chunk_type == b'tRNS':
+      chunks.append(data[offset:end])
+    offset = end
+  return b''.join(chunks)
+
+
+def encode_png_cv2(img, profile='default', quantize_bits=None):
+  '''
+  png file bytes for an 8bit rgb image using opencv
+  profile is a PNG_PROFILES key, quantize_bits optionally posterizes first
+  '''
+  import_cv2()
+  settings = PNG_PROFILES[profile]
+
+  if quantize_bits:
+    img = quantize_image(img, quantize_bits)
+
+  params = []
+  if settings['level'] is not None:
+    params += [cv2.IMWRITE_PNG_COMPRESSION, settings['level']]
+  if settings['strategy'] is not None:
+    params += [cv2.IMWRITE_PNG_STRATEGY, getattr(cv2, settings['strategy'])]
+
+  ok, buf = cv2.imencode('.png', img, params)
+  if not ok:
+    raise ValueError('cannot encode png')
+  data = buf.tobytes()
+
+  if settings['strip']:
+    data = strip_png_chunks(data)
+  return data
+
+
+def import_numpy():
+  'import numpy into this module on first use'
+  #pylint: disable=global-statement,invalid-name
+  global np
+  if np is None:
+    #pylint: disable=import-outside-toplevel,redefined-outer-name
+    import numpy as np
+  return np
+
+
+def import_pil():
+  'PIL.Image when pillow is installed, else None'
+  try:
+    #pylint: disable=import-outside-toplevel
+    from PIL import Image
+  except ImportError:
+    return None
+  return Image
+
+
+def resolve_engine(engine):
+  'auto picks cv2 when it can be imported and the numpy engine otherwise'
+  if engine != 'auto':
+    return engine
+  try:
+    import_cv2()
+  except ImportError:
+    logging.info('cannot import cv2, using the numpy engine')
+    return 'numpy'
+  return 'cv2'
+
+
+def read_image(path, engine='cv2', flags='IMREAD_UNCHANGED'):
+  'decode path with an engine, flags are | separated cv2.IMREAD_* names'
+  if engine == 'cv2':
+    return read_rgb8_image_cv2(path, flags)
+  return read_rgb8_image_numpy(path)
+
+
+def encode_png(img, engine='cv2', profile='default', quantize_bits=None):
+  'png file bytes for img encoded with an engine and a PNG_PROFILES key'
+  if engine == 'cv2':
+    return encode_png_cv2(img, profile, quantize_bits)
+  return encode_png_numpy(img, profile, quantize_bits)
+
+
+def resize_image(img, width, height, interpolation, engine='cv2'):
+  'resize img to width x height, interpolation names a cv2.INTER_* constant'
+  if engine == 'cv2':
+    import_cv2()
+    return cv2.resize(
+        img,
+        dsize=(width, height),
+        interpolation=getattr(cv2, interpolation),
+    )
+  return resize_many_numpy(img, [(height, width)], interpolation)[0]
+
+
+def pad_image(img, top, bottom, left, right, engine='cv2'):
+  'surround img with opaque white borders'
+  if engine == 'cv2':
+    import_cv2()
+    return cv2.copyMakeBorder(
+        img,
+        top=top,
+        bottom=bottom,
+        left=left,
+        right=right,
+        borderType=cv2.BORDER_CONSTANT,
+        value=[255, 255, 255, 255],
+    )
+  return pad_constant_numpy(img, top, bottom, left, right)
+
+
+# numpy engine resampling kinds for cv2 interpolation names, INTER_BITS has
+# the value of INTER_LINEAR_EXACT. like cv2, INTER_AREA only averages areas
+# when neither axis is enlarged and otherwise blends the two nearest pixels
+# with the area_linear weights
+NUMPY_INTERPOLATIONS = {
+    'INTER_AREA': 'area',
+    'INTER_BITS': 'linear',
+    'INTER_CUBIC': 'cubic',
+    'INTER_LANCZOS4': 'lanczos4',
+    'INTER_LINEAR': 'linear',
+    'INTER_LINEAR_EXACT': 'linear',
+    'INTER_NEAREST': 'nearest',
+}
+
+# support of the fixed size kernels, they are not widened when shrinking
+# (no antialiasing) to stay close to cv2
+KERNEL_TAPS = {
+    'linear': 2,
+    'cubic': 4,
+    'lanczos4': 8,
+}
+
+
+def numpy_interpolation(interpolation):
+  'numpy engine resampling kind for a cv2 interpolation name'
+  if interpolation not in NUMPY_INTERPOLATIONS:
+    raise ValueError('%s is not supported by the numpy engine' % interpolation)
+  return NUMPY_INTERPOLATIONS[interpolation]
+
+
+def kernel_weights(kind, distance):
+  'filter weights at a distance in source pixels from the sample center'
+  import_numpy()
+  distance = np.abs(distance)
+  if kind == 'linear':
+    return np.clip(1.0 - distance, 0.0, None)
+  if kind == 'cubic':
+    a = -0.75  # cv2 cubic coefficient
+    near = ((a + 2.0) * distance - (a + 3.0)) * distance * distance + 1.0
+    far = ((a * distance - 5.0 * a) * distance + 8.0 * a) * distance - 4.0 * a
+    return np.where(distance <= 1.0, near, np.where(distance < 2.0, far, 0.0))
+  if kind == 'lanczos4':
+    return np.sinc(distance) * np.sinc(distance / 4.0) * (distance < 4.0)
+  raise ValueError('unknown kernel %s' % kind)
+
+
+def kernel_taps(in_size, out_size, kind):
+  '''
+  source indices and weights, both [out_size, taps], of a fixed support
+  kernel. sample centers are pixel centers and borders are replicated
+  '''
+  import_numpy()
+  scale = in_size / float(out_size)
+
+  if kind == 'nearest':
+    index = np.floor(np.arange(out_size) * scale).astype(np.intp)
+    index = np.minimum(index, in_size - 1)[:, None]
+    return index, np.ones(index.shape)
+
+  if kind == 'area_linear':
+    dst = np.arange(out_size)
+    first = np.floor(dst * scale).astype(np.intp)
+    fraction = (dst + 1) - (first + 1) / scale
+    fraction = np.where(fraction <= 0, 0.0, fraction - np.floor(fraction))
+    index = np.stack([first, first + 1], axis=1)
+    weights = np.stack([1.0 - fraction, fraction], axis=1)
+    return np.clip(index, 0, in_size - 1), weights
+
+  taps = KERNEL_TAPS[kind]
+  center = (np.arange(out_size) + 0.5) * scale - 0.5
+  first = np.floor(center).astype(np.intp) - (taps // 2 - 1)
+  index = first[:, None] + np.arange(taps)[None, :]
+  weights = kernel_weights(kind, center[:, None] - index)
+  weights /= weights.sum(axis=1, keepdims=True)
+  return np.clip(index, 0, in_size - 1), weights
+
+
+def apply_taps(src, index, weights, axis):
+  'weighted sum of src gathered along axis, one vectorized pass per tap'
+  import_numpy()
+  shape = [1] * src.ndim
+  shape[axis] = -1
+  result = None
+  for tap in range(index.shape[1]):
+    term = np.take(src, index[:, tap], axis=axis)
+    term = term * weights[:, tap].reshape(shape)
+    result = term if result is None else result + term
+  return result
+
+
+def cumulative_table(src, axis):
+  'running sums along axis with a leading zero, float64 so sums stay exact'
+  import_numpy()
+  table = np.cumsum(src, axis=axis, dtype=np.float64)
+  padding = [(0, 0)] * src.ndim
+  padding[axis] = (1, 0)
+  return np.pad(table, padding, mode='constant')
+
+
+def area_resample(table, in_size, out_size, axis):
+  '''
+  exact area average of each output cell, fractional edges included, from a
+  cumulative_table(). the table is shared by every output size
+  '''
+  import_numpy()
+  scale = in_size / float(out_size)
+  edges = np.arange(out_size + 1) * scale
+  edges[-1] = in_size
+  lower = np.minimum(np.floor(edges).astype(np.intp), in_size - 1)
+
+  shape = [1] * table.ndim
+  shape[axis] = -1
+  base = np.take(table, lower, axis=axis)
+  step = np.take(table, lower + 1, axis=axis) - base
+  cumulative = base + (edges - lower).reshape(shape) * step
+  return np.diff(cumulative, axis=axis) / scale
+
+
+def resize_many_numpy(img, sizes, interpolation='INTER_AREA'):
+  '''
+  resize img to every (h, w) in sizes with separable numpy filters
+  the vertical pass is batched over all distinct heights: area sizes share a
+  single cumulative table and kernel sizes are gathered in one stacked pass.
+  INTER_AREA output matches cv2 within 1 level per channel
+  '''
+  import_numpy()
+  kind = numpy_interpolation(interpolation)
+  src = img.reshape(img.shape[0], img.shape[1], -1)
+  in_h, in_w = src.shape[:2]
+
+  def size_kind(height, width):
+    if kind == 'area' and (height > in_h or width > in_w):
+      return 'area_linear'
+    return kind
+
+  # vertical pass, once per distinct (height, kind)
+  verticals = sorted(set((h, size_kind(h, w)) for h, w in sizes))
+  columns = {}
+
+  area_verticals = [v for v in verticals if v[1] == 'area']
+  if area_verticals:
+    table = cumulative_table(src, 0)
+    for height, vertical_kind in area_verticals:
+      columns[height, vertical_kind] = area_resample(table, in_h, height, 0)
+
+  # all remaining heights share one kernel so their taps stack
+  tap_verticals = [v for v in verticals if v[1] != 'area']
+  if tap_verticals:
+    taps = [kernel_taps(in_h, h, k) for h, k in tap_verticals]
+    stacked = apply_taps(
+        src.astype(np.float32),
+        np.concatenate([index for index, _ in taps]),
+        np.concatenate([weights for _, weights in taps]),
+        0,
+    )
+    offsets = np.cumsum([0] + [h for h, _ in tap_verticals])
+    for vertical, start, end in zip(tap_verticals, offsets, offsets[1:]):
+      columns[vertical] = stacked[start:end]
+
+  results = []
+  for height, width in sizes:
+    horizontal_kind = size_kind(height, width)
+    rows = columns[height, horizontal_kind]
+    if horizontal_kind == 'area':
+      dst = area_resample(cumulative_table(rows, 1), in_w, width, 1)
+    else:
+      index, weights = kernel_taps(in_w, width, horizontal_kind)
+      dst = apply_taps(rows, index, weights, 1)
+    dst = np.clip(np.rint(dst), 0, 255).astype(np.uint8)
+    results.append(dst.reshape((height, width) + img.shape[2:]))
+  return results
+
+
+def pad_constant_numpy(img, top, bottom, left, right, value=255):
+  'surround img with a constant border on every channel'
+  import_numpy()
+  height, width = img.shape[:2]
+  dst = np.full(
+      (height + top + bottom, width + left + right) + img.shape[2:],
+      value,
+      dtype=img.dtype,
+  )
+  dst[top:top + height, left:left + width] = img
+  return dst
+
+
+# bytes of int16 scratch per wavefront band, bounds the rows in one band
+PNG_BAND_BYTES = 2**26
+
+
+def unfilter_png_band(raw, kinds, prev):
+  '''
+  reconstruct rows of any filter type, all depend on left, up and upper left
+  (a, b, c) so every anti diagonal only needs the two before it. rows are
+  stored skewed, T[d, i] holds row i - 1 at column d - i, making each
+  diagonal one slice. row 0 of T is prev, the row above the band
+  '''
+  rows, width, channels = raw.shape
+  steps = rows + width
+  skewed_raw = np.zeros((steps, rows + 1, channels), dtype=np.int16)
+  out = np.zeros((steps + 1, rows + 1, channels), dtype=np.int16)
+  for i in range(rows):
+    skewed_raw[i + 1:i + 1 + width, i + 1] = raw[i]
+  # out is shifted down one diagonal so d - 2 never wraps around
+  out[1:width + 1, 0] = prev
+  kind = kinds.astype(np.int16)[:, None]
+  paeth = bool((kinds == 4).any())
+
+  for d in range(1, steps):
+    lo = max(1, d - width + 1)
+    hi = min(rows, d) + 1
+    x = skewed_raw[d, lo:hi]
+    a = out[d, lo:hi]
+    b = out[d, lo - 1:hi - 1]
+    choices = [np.zeros_like(x), a, b, (a + b) >> 1]
+    if paeth:
+      c = out[d - 1, lo - 1:hi - 1]
+      dist_a = np.abs(b - c)
+      dist_b = np.abs(a - c)
+      dist_c = np.abs(a + b - 2 * c)
+      choices.append(
+          np.where((dist_a <= dist_b) & (dist_a <= dist_c), a,
+                   np.where(dist_b <= dist_c, b, c)))
+    else:
+      choices.append(choices[0])
+    out[d + 1, lo:hi] = (x + np.choose(kind[lo - 1:hi - 1], choices)) & 0xff
+
+  result = np.empty((rows, width, channels), dtype=np.uint8)
+  for i in range(rows):
+    result[i] = out[i + 2:i + 2 + width, i + 1]
+  return result
+
+
+def unfilter_png(raw, height, width, channels):
+  '''
+  (height, width * channels) pixels from filtered png scanlines, bands
+  without average or paeth rows are reconstructed row by row, the rest by
+  unfilter_png_band()
+  '''
+  kinds = raw[:, 0]
+  lines = raw[:, 1:].reshape(height, width, channels)
+  img = np.empty((height, width, channels), dtype=np.uint8)
+  prev = np.zeros((width, channels), dtype=np.uint8)
+  band = PNG_BAND_BYTES // (4 * (width + height) * channels)
+  band = max(1, min(height, band))
+  for start in range(0, height, band):
+    stop = min(height, start + band)
+    if (kinds[start:stop] >= 3).any():
+      img[start:stop] = unfilter_png_band(lines[start:stop],
+                                          kinds[start:stop], prev)
+    else:
+      for row in range(start, stop):
+        kind = kinds[row]
+        line = lines[row]
+        if kind == 0:
+          cur = line
+        elif kind == 1:
+          cur = np.cumsum(line, axis=0, dtype=np.uint32)
+          cur = (cur & 0xff).astype(np.uint8)
+        else:
+          cur = line + prev
+        img[row] = cur
+        prev = img[row]
+    prev = img[stop - 1]
+  return img.reshape(height, width * channels)
+
+
+def decode_png(data):
+  '''
+  minimal decoder for 8 bit non interlaced png, used when pillow is missing
+  channels match cv2 IMREAD_UNCHANGED, in file (rgb) order
+  '''
+  import_numpy()
+  if data[:8] != PNG_SIGNATURE:
+    raise ValueError('not a png, other formats need pillow')
+
+  offset = len(PNG_SIGNATURE)
+  idat = []
+  palette = None
+  transparency = None
+  while offset < len(data):
+    length, chunk_type = struct.unpack('>I4s', data[offset:offset + 8])
+    body = data[offset + 8:offset + 8 + length]
+    offset += 12 + length
+    if chunk_type == b'IHDR':
+      width, height, depth, color_type, _, _, interlace = struct.unpack(
+          '>IIBBBBB', body)
+    elif chunk_type == b'PLTE':
+      palette = np.frombuffer(body, dtype=np.uint8).reshape(-1, 3)
+    elif chunk_type == b'tRNS':
+      transparency = body
+    elif chunk_type == b'IDAT':
+      idat.append(body)
+    elif chunk_type == b'IEND':
+      break
+
+  if depth != 8 or interlace:
+    raise ValueError('only 8 bit non interlaced png decodes without pillow')
+
+  channels = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}[color_type]
+  stride = width * channels
+  raw = np.frombuffer(zlib.decompress(b''.join(idat)), dtype=np.uint8)
+  raw = raw.reshape(height, stride + 1)
+
+  img = unfilter_png(raw, height, width, channels)
+  img = img.reshape(height, width, channels)
+
+  if color_type == 3:
+    lookup = palette
+    if transparency is not None:
+      alpha = np.full((len(palette), 1), 255, dtype=np.uint8)
+      alpha[:len(transparency), 0] = np.frombuffer(transparency, np.uint8)
+      lookup = np.concatenate([palette, alpha], axis=1)
+    return lookup[img[:, :, 0]]
+  if color_type == 4:
+    gray = img[:, :, :1]
+    return np.concatenate([gray, gray, gray, img[:, :, 1:]], axis=2)
+  if color_type == 2 and transparency is not None:
+    key = np.array(struct.unpack('>HHH', transparency), dtype=np.uint16)
+    alpha = np.where((img == key).all(axis=2), 0, 255).astype(np.uint8)
+    return np.concatenate([img, alpha[:, :, None]], axis=2)
+  if color_type == 0:
+    return img[:, :, 0]
+  return img
+
+
+def encode_png_builtin(img, level):
+  'png bytes using zlib and the sub filter, used when pillow is missing'
+  import_numpy()
+  height, width = img.shape[:2]
+  channels = 1 if img.ndim == 2 else img.shape[2]
+  color_type = {1: 0, 2: 4, 3: 2, 4: 6}[channels]
+
+  rows = img.reshape(height, width * channels)
+  filtered = rows.copy()
+  filtered[:, channels:] -= rows[:, :-channels]
+  raw = np.concatenate([np.ones((height, 1), dtype=np.uint8), filtered], 1)
+
+  def chunk(chunk_type, body):
+    crc = zlib.crc32(chunk_type + body) & 0xffffffff
+    return struct.pack('>I', len(body)) + chunk_type + body + struct.pack(
+        '>I', crc)
+
+  header = struct.pack('>IIBBBBB', width, height, 8, color_type, 0, 0, 0)
+  return b''.join([
+      PNG_SIGNATURE,
+      chunk(b'IHDR', header),
+      chunk(b'IDAT', zlib.compress(raw.tobytes(), level)),
+      chunk(b'IEND', b''),
+  ])
+
+
+def read_rgb8_image_numpy(path):
+  '''
+  read 8bit rgb image with pillow when installed, else the builtin png decoder
+  channels match cv2 IMREAD_UNCHANGED, in file (rgb) order
+  '''
+  import_numpy()
+  image_module = import_pil()
+  if image_module is None:
+    with open(path, 'rb') as fd:
+      return decode_png(fd.read())
+
+  image = image_module.open(path)
+  mode = image.mode
+  if mode == 'P':
+    mode = 'RGBA' if 'transparency' in image.info else 'RGB'
+  elif mode in ('LA', 'PA'):
+    mode = 'RGBA'
+  elif mode == 'RGB' and 'transparency' in image.info:
+    mode = 'RGBA'
+  elif mode == '1':
+    mode = 'L'
+  elif mode not in ('L', 'RGB', 'RGBA'):
+    mode = 'RGB'
+  if mode != image.mode:
+    image = image.convert(mode)
+  return np.array(image)
+
+
+def encode_png_numpy(img, profile='default', quantize_bits=None):
+  'png file bytes for an 8bit rgb image with pillow or the builtin encoder'
+  settings = PNG_PROFILES[profile]
+
+  if quantize_bits:
+    img = quantize_image(img, quantize_bits)
+
+  level = settings['level']
+  if level is None:
+    level = 6  # zlib and pillow default
+
+  image_module = import_pil()
+  if image_module is None:
+    data = encode_png_builtin(img, level)
+  else:
+    buf = io.BytesIO()
+    image_module.fromarray(img).save(buf, format='PNG', compress_level=level)
+    data = buf.getvalue()
+
+  if settings['strip']:
+    data = strip_png_chunks(data)
+  return data
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+# jpeg start of frame markers, excluding DHT (c4), JPG (c8) and DAC (cc)
+JPEG_SOF_MARKERS = frozenset(range(0xc0, 0xd0)) - {0xc4, 0xc8, 0xcc}
+
+
+def probe_png_shape(fd):
+  'h, w, channels from the IHDR chunk, channels as cv2 IMREAD_UNCHANGED has'
+  if fd.read(8) != PNG_SIGNATURE:
+    return None
+  length, chunk_type = struct.unpack('>I4s', fd.read(8))
+  if chunk_type != b'IHDR' or length < 13:
+    raise ValueError('png does not start with IHDR')
+  width, height, _, color_type = struct.unpack('>IIBB', fd.read(10))
+  fd.seek(length - 10 + 4, os.SEEK_CUR)
+
+  if color_type in (4, 6):  # gray + alpha, rgb + alpha
+    return height, width, 4
+  if color_type == 0:  # gray
+    return height, width, 1
+
+  # rgb and palette images gain alpha from a tRNS chunk, which must come
+  # before the first IDAT so only chunk headers need to be read
+  while True:
+    header = fd.read(8)
+    if len(header) < 8:
+      break
+    length, chunk_type = struct.unpack('>I4s', header)
+    if chunk_type == b'tRNS':
+      return height, width, 4
+    if chunk_type in (b'IDAT', b'IEND'):
+      break
+    fd.seek(length + 4, os.SEEK_CUR)
+  return height, width, 3
+
+
+def probe_jpeg_shape(fd):
+  'h, w, channels from the first SOF segment'
+  if fd.read(2) != b'\xff\xd8':
+    return None
+  while True:
+    byte = fd.read(1)
+    if not byte:
+      raise ValueError('jpeg has no SOF segment')
+    if byte != b'\xff':
+      continue
+    marker = fd.read(1)
+    while marker == b'\xff':
+      marker = fd.read(1)
+    if not marker:
+      raise ValueError('jpeg has no SOF segment')
+    marker = ord(marker)
+    if marker == 0x01 or 0xd0 <= marker <= 0xd9:
+      continue  # no payload
+    length, = struct.unpack('>H', fd.read(2))
+    if marker in JPEG_SOF_MARKERS:
+      _, height, width, channels = struct.unpack('>BHHB', fd.read(6))
+      return height, width, channels
+    fd.seek(length - 2, os.SEEK_CUR)
+
+
+def is_jpeg(path):
+  'true when path starts with the jpeg SOI marker'
+  with open(path, 'rb') as fd:
+    return fd.read(2) == b'\xff\xd8'
+
+
+def plan_decode(path, src_shape, intermediates):
+  '''
+  name of the cv2.imread flag to decode src with
+  jpeg sources are decoded at 1/2, 1/4 or 1/8 scale straight from the dct
+  when the reduced image is still at least 2x every intermediate size, so
+  each output is still produced by a proper downscale. IMREAD_REDUCED_* drops
+  alpha and png has no reduced decode (cv2 decodes fully then resamples), so
+  everything else is decoded unchanged. unlike IMREAD_UNCHANGED the reduced
+  flags apply exif orientation, which IMREAD_IGNORE_ORIENTATION turns off so
+  the pixels keep the probed src_shape
+  '''
+  src_h, src_w, channels = src_shape
+  if not intermediates or channels not in (1, 3) or not is_jpeg(path):
+    return 'IMREAD_UNCHANGED'
+
+  need_h = 2 * max(h for h, _ in intermediates)
+  need_w = 2 * max(w for _, w in intermediates)
+  for factor in (8, 4, 2):
+    if src_h // factor >= need_h and src_w // factor >= need_w:
+      return 'IMREAD_REDUCED_%s_%d|IMREAD_IGNORE_ORIENTATION' % (
+          'GRAYSCALE' if channels == 1 else 'COLOR',
+          factor,
+      )
+  return 'IMREAD_UNCHANGED'
+
+
+def probe_image_shape(path):
+  '''
+  (h, w, channels) of a png or jpeg read from its header bytes only
+  None for other formats
+  '''
+  with open(path, 'rb') as fd:
+    for probe in (probe_png_shape, probe_jpeg_shape):
+      fd.seek(0)
+      shape = probe(fd)
+      if shape is not None:
+        return shape
+  return None
+
+
+def image_shape(path):
+  'probe the image header, decoding only formats the probe does not know'
+  shape = probe_image_shape(path)
+  if shape is None:
+    img = read_image(path, resolve_engine('auto'))
+    if img is None:
+      raise ValueError('cannot read image %s' % path)
+    shape = img.shape if img.ndim == 3 else img.shape + (1,)
+  return tuple(shape)
+
+
 def build_info(dir_path):
   'read a specific Contents.json and summarize for default_contents_json()'
 
@@ -327,10 +1058,8 @@ def build_info(dir_path):
   for info in contents['images']:
     icon_path = os.path.join(dir_path, info['filename'])
 
-    tmp_img = read_rgb8_image_cv2(icon_path)
-
     info['filename'] = info['filename'].rsplit('-', 1)[-1]
-    info['shape'] = list(tmp_img.shape)[:-1]
+    info['shape'] = list(image_shape(icon_path))[:-1]
     image_info.append(info)
 
   output = dict(
@@ -344,115 +1073,456 @@ def build_info(dir_path):
   ))
 
 
-def main():
-  'read icons, save out as a directory structure of apple style icons'
-  parser = build_parser()
-  args = parser.parse_args()
+def default_contents_json(iconset):
+  'pick the Contents.json default matching the iconset extension'
+  if iconset.endswith('imageset'):
+    return default_imageset_contents_json()
+  if iconset.endswith('launchimage'):
+    return default_launchimage_contents_json()
+  if iconset.endswith('appiconset'):
+    return default_iconset_contents_json()
+  raise ValueError('%s does not end with .imageset | .launchimage | .appiconset'
+                   % iconset)
 
-  if not args.verbose:
-    logging.getLogger('').setLevel(logging.WARNING)
 
-  build = not args.get_outputs
+def iconset_outputs(asset_build_dir, iconset, src):
+  '''
+  (contents, output_paths) for an iconset without touching any image
+  contents images gain an output 'path' and keep their 'shape'
+  output_paths are (sort width, path) with Contents.json first
+  '''
+  output_icon_path = os.path.join(asset_build_dir, iconset)
+  icon_name = os.path.splitext(os.path.basename(src))[0]
 
-  if args.build_info:
-    build_info(args.src)
+  contents = default_contents_json(iconset)
+
+  contents_path = os.path.join(output_icon_path, 'Contents.json')
+  output_paths = [(-1, contents_path)]
+
+  for info in contents['images']:
+    output_name = icon_name + '-' + info['filename']
+    output_path = os.path.join(output_icon_path, output_name)
+    output_paths.append((info['shape'][1], output_path))
+
+    info['filename'] = output_name
+    info['path'] = output_path
+
+  return contents, output_paths
+
+
+def intermediate_shape(src_shape, target_h, target_w):
+  'size src is scaled to before padding, or None when src is used as is'
+  src_h, src_w = src_shape[:2]
+
+  scale = float(min(target_h, target_w)) / float(max(src_h, src_w))
+
+  return int(scale * src_h), int(scale * src_w)
+
+
+def output_key(src_shape, target_h, target_w, pad_mode):
+  'outputs with equal keys have identical pixels'
+  if tuple(src_shape[:2]) == (target_h, target_w) or pad_mode == 'copy':
+    return ('src',)
+  return (target_h, target_w)
+
+
+def build_pyramid(src_img, smallest_h, smallest_w, engine='cv2'):
+  '''
+  progressively halved copies of src_img, largest first
+  stops once a further halving would drop below 2x the smallest output so the
+  final resize of every output is still at least a 2x area reduction
+  '''
+  pyramid = [src_img]
+  while True:
+    level_h, level_w = pyramid[-1].shape[:2]
+    next_h, next_w = level_h // 2, level_w // 2
+    if next_h < 2 * smallest_h or next_w < 2 * smallest_w:
+      break
+    pyramid.append(
+        resize_image(pyramid[-1], next_w, next_h, 'INTER_AREA', engine))
+  return pyramid
+
+
+def pyramid_level(pyramid, intermediate_h, intermediate_w):
+  'smallest level at least 2x larger than the requested size'
+  for level in reversed(pyramid):
+    level_h, level_w = level.shape[:2]
+    if level_h >= 2 * intermediate_h and level_w >= 2 * intermediate_w:
+      return level
+  return pyramid[0]
+
+
+def resize_and_pad(
+    src_img,
+    target_h,
+    target_w,
+    pad_mode,
+    interpolation,
+    pyramid=None,
+    src_shape=None,
+    engine='cv2',
+    resized=None,
+):
+  '''
+  scale src_img to fit inside target, padding the rest with white
+  interpolation names a cv2.INTER_* constant
+  src_shape is the full resolution shape when src_img was decoded reduced
+  resized is an already scaled intermediate image, see resize_many_numpy()
+  '''
+  if src_shape is None:
+    src_shape = src_img.shape
+  src_h, src_w = src_shape[:2]
+
+  logging.info('%s -> %s', (src_h, src_w), (target_h, target_w))
+
+  if output_key(src_shape, target_h, target_w, pad_mode) == ('src',):
+    return src_img
+
+  intermediate_h, intermediate_w = intermediate_shape(
+      src_shape,
+      target_h,
+      target_w,
+  )
+
+  if resized is not None:
+    dst_img = resized
   else:
-    interpolation = getattr(cv2, args.interpolation)
+    if pyramid:
+      src_img = pyramid_level(pyramid, intermediate_h, intermediate_w)
 
-    output_icon_path = os.path.join(args.asset_build_dir, args.iconset)
+    dst_img = resize_image(
+        src_img,
+        intermediate_w,
+        intermediate_h,
+        interpolation,
+        engine,
+    )
 
-    icon_name = os.path.splitext(os.path.basename(args.src))[0]
+  return pad_to_target(dst_img, target_h, target_w, engine)
 
-    if args.iconset.endswith('imageset'):
-      contents = default_imageset_contents_json()
-    elif args.iconset.endswith('launchimage'):
-      contents = default_launchimage_contents_json()
-    elif args.iconset.endswith('appiconset'):
-      contents = default_iconset_contents_json()
-    else:
-      raise ValueError(
-          '%s does not end with .imageset | .launchimage | .appiconset')
 
-    src_img = None
-    if build:
-      mkdir_cmd = ['mkdir', '-p', output_icon_path]
-      logging.info(' '.join(mkdir_cmd))
-      subprocess.check_call(mkdir_cmd)
+def pad_to_target(img, target_h, target_w, engine='cv2'):
+  'center img on a white target_h x target_w canvas'
+  intermediate_h, intermediate_w = img.shape[:2]
 
-      src_img = read_rgb8_image_cv2(args.src)
+  t_pad = int((target_h - intermediate_h) / 2)
+  b_pad = target_h - intermediate_h - t_pad
 
-    contents_path = os.path.join(output_icon_path, 'Contents.json')
-    output_paths = [(-1, contents_path)]
+  l_pad = int((target_w - intermediate_w) / 2)
+  r_pad = target_w - intermediate_w - l_pad
 
-    for info in contents['images']:
-      output_name = icon_name + '-' + info['filename']
-      output_path = os.path.join(output_icon_path, output_name)
-      output_paths.append((info['shape'][1], output_path))
+  dst_img = pad_image(img, t_pad, b_pad, l_pad, r_pad, engine)
 
-      info['filename'] = output_name
+  final_h, final_w = dst_img.shape[:2]
+  # print( 'final h', final_h, target_h)
+  # print( 'final w', final_w, target_w)
+  assert final_h == target_h, 'h mismatch'
+  assert final_w == target_w, 'h mismatch'
+  return dst_img
 
-      if build:
-        target_h, target_w = info.pop('shape')
 
-        src_h, src_w, _ = src_img.shape
+def link_or_copy(src_path, dst_path):
+  'hardlink an already encoded output, copying where links are unsupported'
+  if os.path.lexists(dst_path):
+    os.remove(dst_path)
+  try:
+    os.link(src_path, dst_path)
+  except OSError:
+    shutil.copyfile(src_path, dst_path)
 
-        print('%s -> %s' % ((src_h, src_w), (target_h, target_w)))
 
-        if (src_h, src_w) == (target_h, target_w):
-          dst_img = src_img
+def hash_file(path):
+  'sha256 hex digest of a file, None when it does not exist'
+  if not os.path.exists(path):
+    return None
+  digest = hashlib.sha256()
+  with open(path, 'rb') as fd:
+    for chunk in iter(lambda: fd.read(1 << 20), b''):
+      digest.update(chunk)
+  return digest.hexdigest()
 
-        elif args.pad_mode == 'copy':
-          dst_img = src_img
 
-        else:
+def write_if_changed(path, data):
+  'replace path with data only when its bytes differ, keeping mtimes stable'
+  if os.path.exists(path) and os.path.getsize(path) == len(data):
+    with open(path, 'rb') as fd:
+      if fd.read() == data:
+        return False
+  # replace rather than rewrite in place so hardlinked duplicates are detached
+  tmp_path = path + '.tmp'
+  with open(tmp_path, 'wb') as fd:
+    fd.write(data)
+  os.replace(tmp_path, path)
+  return True
+
+
+def unique_paths(paths):
+  'paths with hardlinked duplicates removed'
+  seen = set()
+  for path in paths:
+    stat = os.stat(path)
+    if (stat.st_dev, stat.st_ino) not in seen:
+      seen.add((stat.st_dev, stat.st_ino))
+      yield path
 
-          scale = float(min(target_h, target_w)) / float(max(src_h, src_w))
 
-          intermediate_w = int(scale * src_w)
-          intermediate_h = int(scale * src_h)
+def read_iconset_manifest(output_icon_path):
+  'state recorded by the previous build of an iconset, {} if unknown'
+  manifest_path = os.path.join(output_icon_path, MANIFEST_NAME)
+  try:
+    with open(manifest_path) as fd:
+      return json.load(fd)
+  except (IOError, OSError, ValueError):
+    return {}
 
-          dst_img = cv2.resize(
-              src_img,
-              dsize=(intermediate_w, intermediate_h),
-              interpolation=interpolation,
-          )
 
-          t_pad = int((target_h - intermediate_h) / 2)
-          b_pad = target_h - intermediate_h - t_pad
+def build_iconset(
+    asset_build_dir,
+    iconset,
+    src,
+    pad_mode,
+    interpolation,
+    read_src=None,
+    pyramid=False,
+    jobs=1,
+    profile='default',
+    quantize_bits=None,
+    engine='cv2',
+):
+  '''
+  write every png of an iconset plus its Contents.json, print a size / encode
+  time summary for the chosen png profile
+  engine is cv2 or numpy, see resolve_engine()
+  each distinct output is resized and encoded once, duplicates are linked
+  distinct outputs are processed on up to jobs threads
+  outputs recorded in the iconset manifest with unchanged inputs and bytes
+  are skipped, src is only decoded when something has to be generated
+  '''
+  contents, _ = iconset_outputs(asset_build_dir, iconset, src)
+  output_icon_path = os.path.join(asset_build_dir, iconset)
+
+  mkdir_cmd = ['mkdir', '-p', output_icon_path]
+  logging.info(' '.join(mkdir_cmd))
+  subprocess.check_call(mkdir_cmd)
+
+  if read_src is None:
+    read_src = functools.partial(read_image, engine=engine)
+
+  params = dict(
+      src_sha256=hash_file(src),
+      interpolation=interpolation,
+      pad_mode=pad_mode,
+      pyramid=pyramid,
+      profile=profile,
+      quantize_bits=quantize_bits,
+      engine=engine,
+  )
+  previous = read_iconset_manifest(output_icon_path)
+  previous_outputs = {}
+  if previous.get('params') == params:
+    previous_outputs = previous['outputs']
+
+  src_shape = image_shape(src)
+
+  # plan in Contents.json order so links and logs are deterministic
+  unique = collections.OrderedDict()
+  links = []
+  for info in contents['images']:
+    output_path = info.pop('path')
+    target_h, target_w = info.pop('shape')
+
+    key = output_key(src_shape, target_h, target_w, pad_mode)
+    if key not in unique:
+      unique[key] = (output_path, target_h, target_w)
+    elif unique[key][0] != output_path:
+      links.append((unique[key][0], output_path))
+
+  hashes = {}
+  todo = []
+  for item in unique.values():
+    output_path = item[0]
+    sha = hash_file(output_path)
+    if sha is not None and sha == previous_outputs.get(
+        os.path.basename(output_path)):
+      hashes[output_path] = sha
+      logging.info('up to date: %s', output_path)
+    else:
+      todo.append(item)
+
+  encode_seconds = 0.0
+  if todo:
+    if engine != 'cv2' or any(
+        output_key(src_shape, target_h, target_w, pad_mode) == ('src',)
+        for _, target_h, target_w in todo):
+      flags = 'IMREAD_UNCHANGED'
+    else:
+      flags = plan_decode(src, src_shape, [
+          intermediate_shape(src_shape, target_h, target_w)
+          for _, target_h, target_w in todo
+      ])
+    logging.info('decode %s with %s', src, flags)
+    src_img = read_src(src, flags=flags)
+
+    levels = None
+    if pyramid:
+      smallest = min(
+          intermediate_shape(src_shape, target_h, target_w)
+          for _, target_h, target_w in todo)
+      levels = build_pyramid(src_img, *smallest, engine=engine)
+      logging.info('pyramid levels: %s', [lvl.shape[:2] for lvl in levels])
 
-          l_pad = int((target_w - intermediate_w) / 2)
-          r_pad = target_w - intermediate_w - l_pad
+    # the numpy engine resizes every output in one batched pass up front
+    resized = {}
+    if engine == 'numpy' and not pyramid:
+      sizes = [
+          intermediate_shape(src_shape, target_h, target_w)
+          for _, target_h, target_w in todo
+          if output_key(src_shape, target_h, target_w, pad_mode) != ('src',)
+      ]
+      if sizes:
+        resized = dict(
+            zip(sizes, resize_many_numpy(src_img, sizes, interpolation)))
 
-          dst_img = cv2.copyMakeBorder(
-              dst_img,
-              top=t_pad,
-              bottom=b_pad,
-              left=l_pad,
-              right=r_pad,
-              borderType=cv2.BORDER_CONSTANT,
-              value=[255, 255, 255, 255],
-          )
+    def write_output(item):
+      'resize, pad and encode one distinct output'
+      output_path, target_h, target_w = item
+      dst_img = resize_and_pad(
+          src_img,
+          target_h,
+          target_w,
+          pad_mode,
+          interpolation,
+          pyramid=levels,
+          src_shape=src_shape,
+          engine=engine,
+          resized=resized.get(
+              intermediate_shape(src_shape, target_h, target_w)),
+      )
+      start = time.time()
+      data = encode_png(dst_img, engine, profile, quantize_bits)
+      elapsed = time.time() - start
+      written = write_if_changed(output_path, data)
+      return output_path, hashlib.sha256(data).hexdigest(), written, elapsed
 
-          final_h, final_w, _ = dst_img.shape
-          # print( 'final h', final_h, target_h)
-          # print( 'final w', final_w, target_w)
-          assert final_h == target_h, 'h mismatch'
-          assert final_w == target_w, 'h mismatch'
+    # cv2, numpy and zlib release the gil for the heavy lifting
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+      for output_path, sha, written, elapsed in executor.map(
+          write_output, todo):
+        hashes[output_path] = sha
+        encode_seconds += elapsed
+        logging.info('output image: %s%s', output_path,
+                     '' if written else ' (unchanged)')
+
+  for src_path, output_path in links:
+    if hash_file(output_path) != hashes[src_path]:
+      link_or_copy(src_path, output_path)
+      logging.info('output image: %s (same as %s)', output_path, src_path)
+    hashes[output_path] = hashes[src_path]
+
+  contents_path = os.path.join(output_icon_path, 'Contents.json')
+  logging.info('output json: %s', contents_path)
+  write_if_changed(
+      contents_path,
+      json.dumps(contents, indent=2, sort_keys=True).encode('utf-8'),
+  )
+
+  manifest = dict(
+      params=params,
+      outputs=dict(
+          (os.path.basename(path), sha) for path, sha in hashes.items()),
+  )
+  manifest_path = os.path.join(output_icon_path, MANIFEST_NAME)
+  write_if_changed(
+      manifest_path,
+      json.dumps(manifest, indent=2, sort_keys=True).encode('utf-8'),
+  )
+  # the manifest doubles as the build stamp for the cmake custom command
+  os.utime(manifest_path, None)
+
+  total_bytes = sum(os.path.getsize(path) for path in unique_paths(hashes))
+  print('%s: %d pngs %d bytes, encoded %d in %.3fs (%s profile)' % (
+      iconset,
+      len(hashes),
+      total_bytes,
+      len(todo),
+      encode_seconds,
+      profile,
+  ))
+
+
+def read_manifest(path):
+  'list of (iconset, src, pad_mode), relative srcs are next to the manifest'
+  with open(path) as fd:
+    entries = json.load(fd)
+  base = os.path.dirname(os.path.abspath(path))
+  result = []
+  for entry in entries:
+    src = os.path.join(base, entry['src'])
+    result.append((entry['iconset'], src, entry.get('pad_mode', 'pad')))
+  return result
+
+
+def main():
+  'read icons, save out as a directory structure of apple style icons'
+  parser = build_parser()
+  args = parser.parse_args()
+
+  if not args.verbose:
+    logging.getLogger('').setLevel(logging.WARNING)
+
+  build = not args.get_outputs
+
+  if args.build_info:
+    for dir_path in args.src:
+      build_info(dir_path)
+    return
+
+  if args.manifest is not None:
+    entries = read_manifest(args.manifest)
+  elif args.src is not None and args.iconset is not None:
+    srcs = args.src
+    if len(srcs) == 1:
+      srcs = srcs * len(args.iconset)
+    if len(srcs) != len(args.iconset):
+      parser.error('pass one --src or one per --iconset')
+    entries = [(iconset, src, args.pad_mode)
+               for iconset, src in zip(args.iconset, srcs)]
+  else:
+    parser.error('either --manifest or --iconset and --src are required')
 
-        write_rgb8_image_cv2(dst_img, output_path)
+  output_paths = []
+  if build:
+    # sources are decoded lazily and at most once, iconsets sharing a src
+    # are built back to back so only one decoded src is held at a time
+    engine = resolve_engine(args.engine)
+    read_src = functools.lru_cache(maxsize=1)(
+        functools.partial(read_image, engine=engine))
 
-        logging.info('output image: %s', output_path)
+    by_src = collections.OrderedDict()
+    for iconset, src, pad_mode in entries:
+      by_src.setdefault(src, []).append((iconset, pad_mode))
 
-    if build:
-      logging.info('output json: %s', contents_path)
-      with open(contents_path, 'w') as fd:
-        json.dump(contents, fd, indent=2, sort_keys=True)
+    for src, iconsets in by_src.items():
+      for iconset, pad_mode in iconsets:
+        build_iconset(
+            args.asset_build_dir,
+            iconset,
+            src,
+            pad_mode,
+            args.interpolation,
+            read_src=read_src,
+            pyramid=args.pyramid,
+            jobs=args.jobs,
+            profile=args.profile,
+            quantize_bits=args.quantize_bits,
+            engine=engine,
+        )
 
   if args.get_outputs:
-    outputs = []
-    for _, path in sorted(output_paths):
-      outputs.append(path)
-    print('\n'.join(outputs))
+    for iconset, src, _ in entries:
+      _, iconset_paths = iconset_outputs(args.asset_build_dir, iconset, src)
+      output_paths += [path for _, path in sorted(iconset_paths)]
+    print('\n'.join(output_paths))
 
 
 if __name__ == '__main__':
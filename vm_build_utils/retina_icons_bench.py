@@ -0,0 +1,398 @@
+#!/usr/bin/env python
+# Copyright 2020 Alex Harvill
+# SPDX-License-Identifier: Apache-2.0
+'''
+benchmark the retina_icons pipeline on synthetic rgba sources
+
+decode, resize (once per interpolation), pad and encode are timed separately
+for every engine, source size and iconset layout. sources are generated and
+encoded up front and each case runs in a fresh process, so the peak rss it
+reports is its own. results are saved as json and an earlier result can be
+passed as a baseline to flag slowdowns
+'''
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import tempfile
+import multiprocessing
+import concurrent.futures
+
+from . import cmd
+from . import retina_icons
+
+LAYOUTS = ('appiconset', 'imageset', 'launchimage')
+
+
+def interpolation_choices():
+  'the --interpolation choices of retina_icons.py'
+  #pylint: disable=protected-access
+  for action in retina_icons.build_parser()._actions:
+    if action.dest == 'interpolation':
+      return list(action.choices)
+  return ['INTER_AREA']
+
+
+def available_engines():
+  'cv2 and numpy when opencv imports, numpy otherwise'
+  if retina_icons.resolve_engine('auto') == 'cv2':
+    return ['cv2', 'numpy']
+  return ['numpy']
+
+
+def build_parser():
+  'get a parser for this command'
+  parser = argparse.ArgumentParser(description=__doc__)
+
+  parser.add_argument(
+      '-v',
+      '--verbose',
+      help='more debugging info',
+      action='store_true',
+  )
+
+  parser.add_argument(
+      '--sizes',
+      help='edge length of the square synthetic sources',
+      type=int,
+      nargs='+',
+      default=[1024, 2048, 4096],
+  )
+
+  parser.add_argument(
+      '--layouts',
+      help='iconset layouts to generate',
+      nargs='+',
+      default=list(LAYOUTS),
+      choices=LAYOUTS,
+  )
+
+  parser.add_argument(
+      '--engines',
+      help='image engines to time, default is every available one',
+      nargs='+',
+      choices=['cv2', 'numpy'],
+  )
+
+  parser.add_argument(
+      '--interpolations',
+      help='resize weights to time, default is every --interpolation choice',
+      nargs='+',
+      choices=interpolation_choices(),
+  )
+
+  parser.add_argument(
+      '--profile',
+      help='png encoding profile',
+      default='default',
+      choices=sorted(retina_icons.PNG_PROFILES),
+  )
+
+  parser.add_argument(
+      '--repeat',
+      help='keep the best of this many runs of every stage',
+      type=int,
+      default=3,
+  )
+
+  parser.add_argument(
+      '--output',
+      help='json results path',
+      default='retina_icons_bench.json',
+  )
+
+  parser.add_argument(
+      '--baseline',
+      help='earlier json results, exit 1 when a stage got slower',
+  )
+
+  parser.add_argument(
+      '--threshold',
+      help='slowdown ratio against --baseline that counts as a regression',
+      type=float,
+      default=1.25,
+  )
+
+  return parser
+
+
+def synthetic_source(size, seed=0):
+  'deterministic rgba test card: gradients, ripples, a soft alpha disc, noise'
+  np = retina_icons.import_numpy()
+  y, x = np.mgrid[0:size, 0:size].astype(np.float32) / size
+  rng = np.random.default_rng(seed)
+
+  ripple = 127.5 * (1.0 + np.sin(x * 40.0) * np.cos(y * 40.0))
+  radius = np.hypot(x - 0.5, y - 0.5)
+  alpha = np.clip((0.5 - radius) * 4.0, 0.0, 1.0) * 255.0
+
+  img = np.stack([ripple, 255.0 * y, 255.0 * x, alpha], axis=-1)
+  img += rng.normal(0.0, 8.0, img.shape)
+  return np.clip(img, 0, 255).astype(np.uint8)
+
+
+def layout_targets(layout, src_shape):
+  'distinct padded output shapes of a layout, as retina_icons builds them'
+  contents = retina_icons.default_contents_json('bench.' + layout)
+  targets = []
+  for info in contents['images']:
+    target_h, target_w = info['shape']
+    key = retina_icons.output_key(src_shape, target_h, target_w, 'pad')
+    if key != ('src',) and key not in targets:
+      targets.append(key)
+  return targets
+
+
+def best_time(func, repeat):
+  '(fastest wall time of repeat calls, result of the last call)'
+  best = None
+  result = None
+  for _ in range(max(1, repeat)):
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return best, result
+
+
+def stage(seconds, pixels, **extra):
+  'timing summary of one stage with megapixels per second throughput'
+  summary = dict(
+      seconds=seconds,
+      megapixels=pixels / 1e6,
+      megapixels_per_second=pixels / 1e6 / seconds if seconds else None,
+  )
+  summary.update(extra)
+  return summary
+
+
+def resize_all(img, sizes, interpolation, engine):
+  'resize img to every (h, w) the way build_iconset does for an engine'
+  if engine == 'numpy':
+    return retina_icons.resize_many_numpy(img, sizes, interpolation)
+  return [
+      retina_icons.resize_image(img, w, h, interpolation, engine)
+      for h, w in sizes
+  ]
+
+
+def write_source(path, size):
+  'encode the synthetic source of a size to a png file'
+  engine = available_engines()[0]
+  with open(path, 'wb') as fd:
+    fd.write(retina_icons.encode_png(synthetic_source(size), engine, 'fast'))
+
+
+def run_case(engine, src_path, size, layout, interpolations, profile, repeat):
+  'time every stage of one case, meant to run in its own process'
+  result = dict(
+      engine=engine,
+      size=size,
+      layout=layout,
+      profile=profile,
+      stages={},
+      resize={},
+      peak_rss_gb={},
+  )
+  stages = result['stages']
+
+  seconds, img = best_time(
+      lambda: retina_icons.read_image(src_path, engine),
+      repeat,
+  )
+  stages['decode'] = stage(seconds, size * size)
+  result['peak_rss_gb']['decode'] = cmd.get_rss()
+
+  targets = layout_targets(layout, img.shape)
+  sizes = [
+      retina_icons.intermediate_shape(img.shape, h, w) for h, w in targets
+  ]
+  resized_pixels = sum(h * w for h, w in sizes)
+  target_pixels = sum(h * w for h, w in targets)
+  result['outputs'] = len(targets)
+
+  resized = None
+  for interpolation in interpolations:
+    try:
+      seconds, images = best_time(
+          lambda: resize_all(img, sizes, interpolation, engine),
+          repeat,
+      )
+    #pylint: disable=broad-except
+    except Exception as error:
+      result['resize'][interpolation] = dict(error=str(error).strip())
+      continue
+    result['resize'][interpolation] = stage(
+        seconds,
+        resized_pixels,
+        source_megapixels_per_second=len(sizes) * size * size / 1e6 / seconds,
+    )
+    if interpolation == 'INTER_AREA' or resized is None:
+      resized = images
+  result['peak_rss_gb']['resize'] = cmd.get_rss()
+
+  if resized is None:
+    resized = resize_all(img, sizes, 'INTER_AREA', engine)
+
+  seconds, padded = best_time(
+      lambda: [
+          retina_icons.pad_to_target(dst, h, w, engine)
+          for dst, (h, w) in zip(resized, targets)
+      ],
+      repeat,
+  )
+  stages['pad'] = stage(seconds, target_pixels)
+  result['peak_rss_gb']['pad'] = cmd.get_rss()
+
+  seconds, encoded = best_time(
+      lambda: [retina_icons.encode_png(dst, engine, profile) for dst in padded],
+      repeat,
+  )
+  stages['encode'] = stage(
+      seconds,
+      target_pixels,
+      bytes=sum(len(data) for data in encoded),
+  )
+  result['peak_rss_gb']['encode'] = cmd.get_rss()
+
+  return result
+
+
+def run_isolated(*args):
+  'run_case in a fresh spawned process so ru_maxrss only covers that case'
+  context = multiprocessing.get_context('spawn')
+  with concurrent.futures.ProcessPoolExecutor(
+      max_workers=1,
+      mp_context=context,
+  ) as executor:
+    return executor.submit(run_case, *args).result()
+
+
+def environment():
+  'versions that explain differences between result files'
+  info = dict(
+      python=platform.python_version(),
+      platform=platform.platform(),
+      machine=platform.machine(),
+      cpu_count=os.cpu_count(),
+      numpy=retina_icons.import_numpy().__version__,
+  )
+  try:
+    info['cv2'] = retina_icons.import_cv2().__version__
+  except ImportError:
+    info['cv2'] = None
+  return info
+
+
+def case_key(case):
+  'identity of a case across result files'
+  return (case['engine'], case['size'], case['layout'])
+
+
+def stage_times(case):
+  '{stage name: seconds} including one resize entry per interpolation'
+  times = dict((name, info['seconds']) for name, info in case['stages'].items())
+  for interpolation, info in case['resize'].items():
+    if 'seconds' in info:
+      times['resize ' + interpolation] = info['seconds']
+  return times
+
+
+def compare(results, baseline, threshold):
+  'log every stage slower than threshold x its baseline, return the count'
+  previous = dict((case_key(case), case) for case in baseline['cases'])
+  regressions = 0
+  for case in results['cases']:
+    old_case = previous.get(case_key(case))
+    if old_case is None:
+      continue
+    old_times = stage_times(old_case)
+    for name, seconds in sorted(stage_times(case).items()):
+      old_seconds = old_times.get(name)
+      if not old_seconds:
+        continue
+      ratio = seconds / old_seconds
+      if ratio > threshold:
+        regressions += 1
+        logging.warning('%s %d %s %s: %.4fs -> %.4fs (%.2fx slower)',
+                        case['engine'], case['size'], case['layout'], name,
+                        old_seconds, seconds, ratio)
+  return regressions
+
+
+def log_case(case):
+  'one line throughput summary of a case'
+  area = case['resize'].get('INTER_AREA', {})
+  logging.info(
+      '%s %5d %-11s decode %7.1f MP/s  resize %7.1f MP/s  pad %7.1f MP/s  '
+      'encode %6.1f MP/s %9d bytes  peak rss %.2f GB',
+      case['engine'],
+      case['size'],
+      case['layout'],
+      case['stages']['decode']['megapixels_per_second'],
+      area.get('megapixels_per_second') or 0.0,
+      case['stages']['pad']['megapixels_per_second'],
+      case['stages']['encode']['megapixels_per_second'],
+      case['stages']['encode']['bytes'],
+      max(case['peak_rss_gb'].values()),
+  )
+
+
+def main():
+  'time the icon pipeline, save json results, compare with a baseline'
+  parser = build_parser()
+  args = parser.parse_args()
+
+  logging.basicConfig(
+      level=logging.DEBUG if args.verbose else logging.INFO,
+      format='%(message)s',
+  )
+
+  engines = args.engines or available_engines()
+  interpolations = args.interpolations or interpolation_choices()
+
+  results = dict(
+      environment=environment(),
+      repeat=args.repeat,
+      cases=[],
+  )
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    sources = {}
+    for size in args.sizes:
+      sources[size] = os.path.join(tmp_dir, 'src-%d.png' % size)
+      write_source(sources[size], size)
+
+    for engine in engines:
+      for size in args.sizes:
+        for layout in args.layouts:
+          case = run_isolated(
+              engine,
+              sources[size],
+              size,
+              layout,
+              interpolations,
+              args.profile,
+              args.repeat,
+          )
+          log_case(case)
+          results['cases'].append(case)
+
+  with open(args.output, 'w') as fd:
+    json.dump(results, fd, indent=2, sort_keys=True)
+  logging.info('wrote %s', args.output)
+
+  if args.baseline:
+    with open(args.baseline) as fd:
+      baseline = json.load(fd)
+    regressions = compare(results, baseline, args.threshold)
+    if regressions:
+      logging.warning('%d stages slower than %.2fx the baseline', regressions,
+                      args.threshold)
+      sys.exit(1)
+
+
+if __name__ == '__main__':
+  main()
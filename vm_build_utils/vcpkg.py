@@ -1,30 +1,371 @@
 # Copyright 2020 Alex Harvill
 # SPDX-License-Identifier: Apache-2.0
 'utilities for vcpkg builds'
+import os
+import re
 import sys
 import json
+import time
+import shutil
+import hashlib
 import logging
+import threading
 import subprocess
+import concurrent.futures
 from pathlib import Path
 from . import cmd
 
 
+def read_control_paragraphs(path):
+  'yields one dict per blank line separated paragraph of a vcpkg control file'
+  paragraph = {}
+  key = None
+  with open(path, encoding='utf-8') as fd:
+    for line in fd:
+      line = line.rstrip('\n')
+      if not line.strip():
+        if paragraph:
+          yield paragraph
+        paragraph = {}
+        key = None
+      elif line[0] in ' \t' and key is not None:
+        paragraph[key] += '\n' + line.strip()
+      elif ':' in line:
+        key, value = line.split(':', 1)
+        paragraph[key] = value.strip()
+  if paragraph:
+    yield paragraph
+
+
+def read_status_db(installed_root):
+  '''
+  dict of (package, triplet) to its core status paragraph for every package
+  vcpkg lists as installed, pending updates files are applied in order
+  '''
+  db_dir = Path(installed_root) / 'vcpkg'
+  paths = [db_dir / 'status']
+  updates_dir = db_dir / 'updates'
+  if updates_dir.is_dir():
+    paths += sorted(updates_dir.iterdir())
+
+  latest = {}
+  for path in paths:
+    if not path.is_file():
+      continue
+    for paragraph in read_control_paragraphs(path):
+      if 'Package' not in paragraph or 'Feature' in paragraph:
+        continue
+      latest[(paragraph['Package'], paragraph.get('Architecture'))] = paragraph
+
+  return {
+      key: value
+      for key, value in latest.items()
+      if value.get('Status', '').endswith(' installed')
+  }
+
+
+def port_name(pkg):
+  'strip a feature list: boost[core,json] -> boost'
+  return pkg.split('[', 1)[0].split(':', 1)[0]
+
+
+def hash_path(digest, path):
+  'fold the relative names and bytes of a file or directory tree into digest'
+  path = Path(path)
+  if path.is_file():
+    files = [path]
+  elif path.is_dir():
+    files = sorted(x for x in path.rglob('*') if x.is_file())
+  else:
+    digest.update(b'missing:' + str(path).encode('utf-8'))
+    return
+  for file_path in files:
+    digest.update(str(file_path.relative_to(path.parent)).encode('utf-8'))
+    with open(file_path, 'rb') as fd:
+      digest.update(fd.read())
+
+
+def seed_downloads(mirror, downloads):
+  '''
+  link mirror files missing from downloads, hard links when the mirror is on
+  the same filesystem and symlinks otherwise, so no archive is copied
+  '''
+  mirror = Path(mirror).resolve()
+  downloads.mkdir(parents=True, exist_ok=True)
+  seeded = 0
+  for src in mirror.iterdir():
+    dst = downloads / src.name
+    if not src.is_file() or dst.exists():
+      continue
+    try:
+      os.link(str(src), str(dst))
+    except OSError:
+      os.symlink(str(src), str(dst))
+    seeded += 1
+  logging.info('seeded [%i] downloads from mirror [%s]', seeded, mirror)
+
+
+PORT_SPEC = r'(?:package )?([a-z0-9][a-z0-9-]*)(?:\[[^\]]*\])?:([\w-]+)'
+PORT_START = re.compile(r'^(?:Building|Installing \d+/\d+) ' + PORT_SPEC)
+PORT_INSTALL = re.compile(r'^Installing (?:\d+/\d+ )?' + PORT_SPEC)
+PORT_END = re.compile(r'^Elapsed time (?:to handle|for package) ' + PORT_SPEC)
+PORT_FAILED = re.compile(r'^Error: Building ' + PORT_SPEC +
+                         r'.* failed with: (\w+)', re.IGNORECASE)
+PORT_PHASES = (
+    ('-- Downloading', 'download'),
+    ('-- Using cached', 'download'),
+    ('-- Fetching', 'download'),
+    ('-- Extracting', 'download'),
+    ('-- Configuring', 'configure'),
+    ('-- Building', 'build'),
+    ('-- Installing', 'install'),
+    ('-- Performing post-build validation', 'install'),
+)
+
+
+class PortTimer():
+  '''
+  follows the output of one vcpkg install and records, per port, when each
+  download / configure / build / install phase started, the outcome and the
+  buildtrees logs vcpkg points at on failure
+  '''
+
+  def __init__(self):
+    self.ports = {}
+    self.current = None
+    self.expect_logs = False
+
+  def port(self, name, triplet):
+    'record for a port, created on first sight'
+    key = '%s:%s' % (name, triplet)
+    if key not in self.ports:
+      self.ports[key] = dict(
+          port=name,
+          triplet=triplet,
+          start=None,
+          end=None,
+          phases=[],
+          outcome='unknown',
+          logs=[],
+      )
+    return self.ports[key]
+
+  def enter(self, record, phase, now):
+    'start a phase unless it is already the current one'
+    if record['start'] is None:
+      record['start'] = now
+    if not record['phases'] or record['phases'][-1][0] != phase:
+      record['phases'].append([phase, now])
+
+  def __call__(self, line):
+    'cmd.execute on_line callback'
+    now = time.time()
+    text = line.decode('utf-8', 'replace').strip()
+
+    if self.expect_logs:
+      if text.endswith('.log'):
+        self.current['logs'].append(text)
+        return
+      self.expect_logs = False
+
+    match = PORT_END.match(text)
+    if match:
+      record = self.port(*match.groups())
+      record['end'] = now
+      if record['outcome'] == 'unknown':
+        record['outcome'] = 'SUCCEEDED'
+      return
+
+    match = PORT_FAILED.match(text)
+    if match:
+      name, triplet, outcome = match.groups()
+      self.current = record = self.port(name, triplet)
+      record['outcome'] = outcome
+      record['end'] = now
+      return
+
+    if text.startswith('See logs for more information') and self.current:
+      self.expect_logs = True
+      return
+
+    match = PORT_INSTALL.match(text)
+    if match and self.current is self.port(*match.groups()):
+      self.enter(self.current, 'install', now)
+      return
+
+    match = PORT_START.match(text)
+    if match:
+      self.current = self.port(*match.groups())
+      self.enter(self.current, 'download', now)
+      return
+
+    if self.current is not None:
+      for prefix, phase in PORT_PHASES:
+        if text.startswith(prefix):
+          self.enter(self.current, phase, now)
+          break
+
+  def finish(self, samples=()):
+    '''
+    per port durations in seconds for each phase plus total and peak rss
+    from ResourceSampler samples taken while the port was being handled
+    '''
+    result = []
+    for record in self.ports.values():
+      end = record['end'] or time.time()
+      durations = {}
+      phases = record['phases']
+      for index, (phase, start) in enumerate(phases):
+        stop = phases[index + 1][1] if index + 1 < len(phases) else end
+        durations[phase] = durations.get(phase, 0.0) + stop - start
+      start = record['start'] or end
+      peak = [
+          x['tree_rss_gb'] for x in samples if start <= x['time'] <= end
+      ]
+      result.append(
+          dict(
+              port=record['port'],
+              triplet=record['triplet'],
+              outcome=record['outcome'],
+              total=end - start,
+              download=durations.get('download', 0.0),
+              configure=durations.get('configure', 0.0),
+              build=durations.get('build', 0.0),
+              install=durations.get('install', 0.0),
+              peak_rss_gb=max(peak) if peak else -1,
+              logs=record['logs'],
+              log_tail=tail_lines(record['logs'][-1]) if record['logs'] else [],
+          ))
+    return result
+
+
+def tail_lines(path, count=20):
+  'last lines of a buildtrees log, empty if it cannot be read'
+  try:
+    with open(path, 'rb') as fd:
+      fd.seek(0, os.SEEK_END)
+      fd.seek(max(0, fd.tell() - 8192))
+      lines = fd.read().decode('utf-8', 'replace').split('\n')
+  except OSError:
+    return []
+  return [x for x in lines if x.strip()][-count:]
+
+
+def log_port_report(report, level=logging.INFO):
+  'table of per port timings, slowest first'
+  columns = ('download', 'configure', 'build', 'install', 'total')
+  logging.log(
+      level, '%s %s %s %s',
+      'port'.ljust(40), ' '.join(x.rjust(9) for x in columns),
+      'rss GB'.rjust(7), 'outcome')
+  for entry in sorted(report, key=lambda x: -x['total']):
+    logging.log(
+        level,
+        '%s %s %s %s',
+        ('%s:%s' % (entry['port'], entry['triplet'])).ljust(40),
+        ' '.join(('%.1f' % entry[x]).rjust(9) for x in columns),
+        ('%.2f' % entry['peak_rss_gb']).rjust(7),
+        entry['outcome'],
+    )
+    for log in entry['logs']:
+      logging.log(level, '    %s', log)
+
+
+class BinaryCache():
+  '''
+  vcpkg binary cache in a local directory (files provider) or behind an http
+  server (a directory server can stand in for it), hit and miss reporting and
+  least recently used pruning only apply to local directories
+  '''
+
+  def __init__(self, location, max_bytes=None):
+    self.location = str(location)
+    self.is_http = self.location.startswith(('http://', 'https://'))
+    self.directory = None
+    if not self.is_http:
+      self.directory = Path(self.location).expanduser().resolve()
+    self.max_bytes = max_bytes
+    self.before = set()
+
+  def binary_sources(self):
+    'value for VCPKG_BINARY_SOURCES'
+    if self.is_http:
+      url = self.location
+      if '{sha}' not in url:
+        url = url.rstrip('/') + '/{sha}.zip'
+      return 'clear;http,%s,readwrite' % url
+    return 'clear;files,%s,readwrite' % self.directory
+
+  def archives(self):
+    'dict of abi hash to archive path, the files provider uses <ab>/<abi>.zip'
+    if self.directory is None or not self.directory.is_dir():
+      return {}
+    return {x.stem: x for x in self.directory.glob('*/*.zip')}
+
+  def snapshot(self):
+    'remember which archives exist before vcpkg runs'
+    self.directory.mkdir(parents=True, exist_ok=True)
+    self.before = set(self.archives())
+
+  def report(self, status_before, status_after):
+    '''
+    list of (package, triplet, abi, hit) for every package whose abi changed
+    during the run, hit when its archive was already in the cache
+    archives that were hit are touched so pruning keeps them
+    '''
+    archives = self.archives()
+    result = []
+    for key, paragraph in sorted(status_after.items()):
+      abi = paragraph.get('Abi')
+      before = status_before.get(key)
+      if abi is None or (before is not None and before.get('Abi') == abi):
+        continue
+      hit = abi in self.before
+      if hit and abi in archives:
+        os.utime(archives[abi])
+      result.append((key[0], key[1], abi, hit))
+    return result
+
+  def prune(self):
+    'delete least recently used archives until under max_bytes'
+    if self.max_bytes is None:
+      return
+    for path in cmd.prune_lru(self.archives().values(), self.max_bytes):
+      logging.debug('pruned binary cache archive [%s]', path)
+
+
 class Build():
   'calls vcpkg to build and then potentially install libs into venv'
 
-  def __init__(self, run_mode, source_root, json_path):
+  def __init__(
+      self,
+      run_mode,
+      source_root,
+      json_path,
+      timeout=None,
+      jobs=None,
+      parallel_triplets=1,
+      force=False,
+      binary_cache=None,
+      binary_cache_max_gb=None,
+  ):
 
     self.run_mode = run_mode
+    self.timeout = timeout
+    self.jobs = jobs or os.cpu_count() or 1
+    self.parallel_triplets = parallel_triplets or 1
+    self.force = force
     self.source_root = Path(source_root).resolve()
 
     with open(json_path) as fd:
       config = json.load(fd)
 
-    os = sys.platform.lower()
-    if os.startswith('linux'):
-      os = 'linux'
-    assert os in config, 'missing os[%s] in[%s]' % (os, str(json_path))
-    self.config = config[os]
+    os_name = sys.platform.lower()
+    if os_name.startswith('linux'):
+      os_name = 'linux'
+    assert os_name in config, 'missing os[%s] in[%s]' % (os_name,
+                                                         str(json_path))
+    self.config = config[os_name]
 
     self.vcpkg_path = self.source_root / self.config['vcpkg_path']
     self.pkg_root = self.source_root / self.config['pkg_root']
@@ -32,6 +373,29 @@ class Build():
     self.pkgs = self.config['pkgs']
     self.triplet_overlay = self.config['triplet_overlay']
     self.ports_overlay = self.config['triplet_overlay'] + '/ports'
+    self.log_dir = self.vcpkg_path.parent / 'logs'
+    self.installed_root = self.vcpkg_path.parent / 'installed'
+    self.stamp_path = self.installed_root / 'vcpkg' / 'vm_build_utils.json'
+    self.stamp_lock = threading.Lock()
+    self.report = []
+    self.report_path = self.log_dir / 'report.json'
+
+    binary_cache = binary_cache or self.config.get('binary_cache')
+    if binary_cache_max_gb is None:
+      binary_cache_max_gb = self.config.get('binary_cache_max_gb')
+    self.binary_cache = None
+    if binary_cache:
+      max_bytes = None
+      if binary_cache_max_gb is not None:
+        max_bytes = int(float(binary_cache_max_gb) * cmd.GB)
+      if '://' not in binary_cache:
+        # ~ first, a relative path is then taken from source_root
+        binary_cache = Path(self.source_root,
+                            os.path.expanduser(binary_cache))
+      self.binary_cache = BinaryCache(
+          binary_cache,
+          max_bytes=max_bytes,
+      )
 
   def check_call(self, cmd_args, cwd, **kwargs):
     'call a subprocess, exit on error or return on success'
@@ -40,8 +404,9 @@ class Build():
                          cwd=str(cwd),
                          run_mode=self.run_mode,
                          log_level=logging.INFO,
+                         timeout=self.timeout,
                          **kwargs)
-    except subprocess.CalledProcessError:
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
       sys.exit(666)
 
   def rel_vcpkg_path(self):
@@ -60,23 +425,361 @@ class Build():
 
     self.check_call([str(bootstrap_path)], self.source_root)
 
-  def build(self):
-    'run a vcpkg install command to build libs'
+  def resolve_overlay(self, overlay, *parts):
+    'path to an overlay file or port, relative overlays are under source_root'
+    return (self.source_root / overlay).joinpath(*parts)
+
+  def port_dir(self, pkg):
+    'overlay port directory if one exists, else the builtin vcpkg port'
+    overlay = self.resolve_overlay(self.ports_overlay, port_name(pkg))
+    if overlay.is_dir():
+      return overlay
+    return self.vcpkg_path.parent / 'ports' / port_name(pkg)
+
+  def triplet_file(self, triplet):
+    'overlay triplet file if one exists, else a builtin triplet'
+    name = triplet + '.cmake'
+    candidates = [
+        self.resolve_overlay(self.triplet_overlay, name),
+        self.vcpkg_path.parent / 'triplets' / name,
+        self.vcpkg_path.parent / 'triplets' / 'community' / name,
+    ]
+    for candidate in candidates:
+      if candidate.is_file():
+        return candidate
+    return candidates[0]
+
+  def input_hash(self, pkg, triplet):
+    '''
+    hash of what an install of pkg for triplet depends on: its port, every
+    overlay port (dependencies), the triplet file and the builtin ports baseline
+    '''
+    digest = hashlib.sha256()
+    digest.update(('%s:%s' % (pkg, triplet)).encode('utf-8'))
+    hash_path(digest, self.port_dir(pkg))
+    hash_path(digest, self.resolve_overlay(self.ports_overlay))
+    hash_path(digest, self.triplet_file(triplet))
+    hash_path(digest, self.vcpkg_path.parent / 'versions' / 'baseline.json')
+    return digest.hexdigest()
+
+  def read_stamps(self):
+    'dict of "pkg:triplet" to the input hash of its last successful install'
+    try:
+      with open(self.stamp_path) as fd:
+        return json.load(fd)
+    except (FileNotFoundError, ValueError):
+      return {}
+
+  def write_stamps(self, triplet, pkgs):
+    'record the input hashes of freshly installed packages'
+    with self.stamp_lock:
+      stamps = self.read_stamps()
+      for pkg in pkgs:
+        stamps['%s:%s' % (pkg, triplet)] = self.input_hash(pkg, triplet)
+      cmd.atomic_write(self.stamp_path,
+                       json.dumps(stamps, indent=2, sort_keys=True))
+
+  def plan(self):
+    '''
+    list of (pkg, triplet, stale, reason) for every configured entry
+    an entry is up to date when the status db lists it as installed and its
+    input hash matches the one recorded after its last install
+    '''
+    status = read_status_db(self.installed_root)
+    stamps = self.read_stamps()
 
-    lib_dir = str(cmd.env_root('lib'))
+    result = []
     for pkg, triplets in self.pkgs.items():
       for triplet in triplets:
+        if self.force:
+          stale, reason = True, 'forced'
+        elif (port_name(pkg), triplet) not in status:
+          stale, reason = True, 'not installed'
+        elif '%s:%s' % (pkg, triplet) not in stamps:
+          stale, reason = True, 'no stamp'
+        elif stamps['%s:%s' % (pkg, triplet)] != self.input_hash(pkg, triplet):
+          stale, reason = True, 'port or triplet changed'
+        else:
+          stale, reason = False, 'up to date'
+        result.append((pkg, triplet, stale, reason))
+    return result
+
+  def log_plan(self, plan, level=logging.INFO):
+    'one line per planned entry'
+    for pkg, triplet, stale, reason in plan:
+      verb = cmd.yellow_text('install') if stale else cmd.green_text('skip')
+      logging.log(level, '%s %s:%s (%s)', verb.ljust(20), pkg, triplet, reason)
+
+  def triplet_batches(self, plan=None):
+    '''
+    dict of triplet to the list of packages to install for it, config order
+    with a plan only stale entries are included
+    '''
+    if plan is None:
+      plan = [(pkg, triplet, True, '')
+              for pkg, triplets in self.pkgs.items()
+              for triplet in triplets]
+    result = {}
+    for pkg, triplet, stale, _ in plan:
+      if stale:
+        result.setdefault(triplet, []).append(pkg)
+    return result
+
+  def install(self, triplet, pkgs, max_concurrency):
+    '''
+    one vcpkg install for every package of a triplet, its output is echoed
+    at INFO and logged to its own file. vcpkg install leaves ports that are already installed alone, so stale
+    ones are removed first. remove --recurse also takes their dependents,
+    configured packages among them are installed again with the batch
+    '''
+    env = dict(os.environ)
+    env['INSTALL_NAME_DIR'] = str(cmd.env_root('lib'))
+    env['VCPKG_MAX_CONCURRENCY'] = str(max_concurrency)
+    if self.binary_cache is not None:
+      env['VCPKG_BINARY_SOURCES'] = self.binary_cache.binary_sources()
+
+    log_path = self.log_dir / ('install-%s.log' % triplet)
+
+    status = read_status_db(self.installed_root)
+    remove_specs = sorted(
+        set('%s:%s' % (port_name(x), triplet)
+            for x in pkgs
+            if (port_name(x), triplet) in status))
+    remove_cmd = [self.vcpkg_path, 'remove', '--recurse'] + remove_specs
+    if remove_specs:
+      pkgs = pkgs + [
+          x for x, triplets in self.pkgs.items()
+          if triplet in triplets and x not in pkgs
+      ]
+
+    install_cmd = [
+        self.vcpkg_path,
+        'install',
+        '--recurse',
+        '--triplet',
+        triplet,
+    ] + self.overlay_args() + pkgs
+
+    samples_path = self.log_dir / ('samples-%s.json' % triplet)
+
+    logging.info('vcpkg [%s] x%i jobs log [%s]', triplet, max_concurrency,
+                 log_path)
+
+    # decide up front so nothing is written for installs that do not run
+    cmds = ([remove_cmd] if remove_specs else []) + [install_cmd]
+    go = cmd.confirm(
+        self.run_mode,
+        ' && '.join(
+            subprocess.list2cmdline([str(x) for x in c]) for c in cmds),
+    )
+    if not go:
+      cmd.execute(
+          install_cmd,
+          cwd=str(self.source_root),
+          run_mode=cmd.RUN_CMD_NEVER,
+          log_level=logging.INFO,
+      )
+      return
+
+    self.log_dir.mkdir(parents=True, exist_ok=True)
+    if samples_path.exists():
+      samples_path.unlink()
+    if remove_specs:
+      cmd.execute(
+          remove_cmd,
+          cwd=str(self.source_root),
+          log_level=logging.INFO,
+          timeout=self.timeout,
+      )
+
+    timer = PortTimer()
+
+    def on_line(line):
+      timer(line)
+      logging.info('%s', line.decode('utf-8', 'replace').rstrip())
+
+    try:
+      cmd.execute(
+          install_cmd,
+          cwd=str(self.source_root),
+          log_level=logging.INFO,
+          env=env,
+          timeout=self.timeout,
+          log_path=log_path,
+          on_line=on_line,
+          sample_path=samples_path,
+          sample_interval=2.0,
+      )
+    finally:
+      samples = []
+      if samples_path.exists():
+        with open(samples_path) as fd:
+          samples = json.load(fd)['samples']
+      with self.stamp_lock:
+        self.report += timer.finish(samples)
+
+    status = read_status_db(self.installed_root)
+    self.write_stamps(
+        triplet,
+        [x for x in pkgs if (port_name(x), triplet) in status],
+    )
+
+  def overlay_args(self):
+    'overlay triplet and port arguments shared by every vcpkg call'
+    return [
+        '--overlay-triplets=%s' % self.triplet_overlay,
+        '--overlay-ports=%s' % self.ports_overlay,
+    ]
+
+  def download(self, specs, log_path):
+    '''
+    fetch the source archives of the dependency closure of "pkg:triplet"
+    specs in one vcpkg process, so every port is planned and fetched once.
+    vcpkg cannot fetch a port without processing its dependencies, so the
+    fetching itself is serial. a private install root makes vcpkg fetch
+    ports that are already installed but stale
+    '''
+    scratch = self.vcpkg_path.parent / 'buildtrees' / 'prefetch'
+    download_cmd = [
+        self.vcpkg_path,
+        'install',
+        '--only-downloads',
+        '--x-install-root=%s' % (scratch / 'installed'),
+        '--x-packages-root=%s' % (scratch / 'packages'),
+        '--x-buildtrees-root=%s' % (scratch / 'buildtrees'),
+    ] + self.overlay_args() + specs
+
+    go = cmd.confirm(
+        self.run_mode,
+        subprocess.list2cmdline([str(x) for x in download_cmd]),
+    )
+    if go:
+      self.log_dir.mkdir(parents=True, exist_ok=True)
+    try:
+      cmd.execute(
+          download_cmd,
+          cwd=str(self.source_root),
+          run_mode=cmd.RUN_CMD_ALWAYS if go else cmd.RUN_CMD_NEVER,
+          log_level=logging.INFO,
+          timeout=self.timeout,
+          log_path=log_path,
+      )
+    finally:
+      if go:
+        shutil.rmtree(str(scratch), ignore_errors=True)
+
+  def prefetch(self, mirror=None):
+    '''
+    download the sources of the full dependency closure of every stale
+    package before building, files found in a local mirror directory are
+    linked into the downloads directory first
+    '''
+    if mirror is not None:
+      cmd.execute_callback(
+          'seed vcpkg downloads from [%s]' % mirror,
+          seed_downloads,
+          (mirror, self.vcpkg_path.parent / 'downloads'),
+          {},
+          run_mode=self.run_mode,
+          log_arguments=False,
+          log_level=logging.INFO,
+      )
+
+    specs = []
+    for triplet, pkgs in self.triplet_batches(self.plan()).items():
+      specs += ['%s:%s' % (pkg, triplet) for pkg in pkgs]
+    if not specs:
+      return
+
+    logging.info('prefetching sources for [%i] packages', len(specs))
+    log_path = self.log_dir / 'download.log'
+    try:
+      self.download(specs, log_path)
+    except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+      logging.error('prefetch failed see [%s]', log_path)
+      sys.exit(666)
+
+  def build(self):
+    '''
+    run vcpkg install once per triplet with every package for that triplet,
+    one triplet at a time with the full jobs budget by default. vcpkg locks
+    the shared install root, so parallel_triplets > 1 mostly trades cores
+    for waiting on that lock
+    entries the status db and input hashes show as up to date are skipped
+    '''
+    plan = self.plan()
+    self.log_plan(plan)
+    batches = self.triplet_batches(plan)
+    if not batches:
+      logging.info('all vcpkg packages up to date')
+      return
+
+    workers = min(len(batches), self.parallel_triplets)
+    max_concurrency = max(1, self.jobs // workers)
+
+    report_cache = (self.binary_cache is not None and
+                    not self.binary_cache.is_http and
+                    self.run_mode != cmd.RUN_CMD_NEVER)
+    if report_cache:
+      status_before = read_status_db(self.installed_root)
+      self.binary_cache.snapshot()
+
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+      futures = {
+          pool.submit(self.install, triplet, pkgs, max_concurrency): triplet
+          for triplet, pkgs in batches.items()
+      }
+      try:
+        for future in concurrent.futures.as_completed(futures):
+          triplet = futures[future]
+          try:
+            future.result()
+          except (subprocess.CalledProcessError, subprocess.TimeoutExpired):
+            logging.error('vcpkg install failed for [%s] see [%s]', triplet,
+                          self.log_dir / ('install-%s.log' % triplet))
+            failed.append(triplet)
+      except KeyboardInterrupt:
+        for future in futures:
+          future.cancel()
+        cmd.terminate_all_processes()
+        raise
+
+    if report_cache:
+      self.log_binary_cache_report(status_before)
+
+    self.write_report()
+
+    if failed:
+      sys.exit(666)
+
+  def write_report(self):
+    'log the per port timing table and save it as json'
+    if not self.report:
+      return
+    log_port_report(self.report)
+    with open(self.report_path, 'w') as fd:
+      json.dump(
+          sorted(self.report, key=lambda x: -x['total']),
+          fd,
+          indent=2,
+      )
+    logging.info('vcpkg port report [%s]', self.report_path)
 
-        build_cmd = ' '.join([
-            'INSTALL_NAME_DIR=' + lib_dir,
-            str(self.vcpkg_path),
-            'install',
-            '--recurse',
-            '--triplet',
-            triplet,
-            '--overlay-triplets=%s' % self.triplet_overlay,
-            '--overlay-ports=%s' % self.ports_overlay,
-            pkg,
-        ])
-        logging.info(build_cmd)
-        subprocess.check_call(build_cmd, shell=True)
+  def log_binary_cache_report(self, status_before):
+    'log binary cache hits and misses per package and triplet, then prune'
+    report = self.binary_cache.report(
+        status_before,
+        read_status_db(self.installed_root),
+    )
+    for pkg, triplet, abi, hit in report:
+      verb = cmd.green_text('hit ') if hit else cmd.yellow_text('miss')
+      logging.info('binary cache %s %s:%s [%s]', verb, pkg, triplet, abi[:12])
+    hits = sum(1 for x in report if x[3])
+    logging.info(
+        'binary cache [%s] hits [%i] misses [%i]',
+        self.binary_cache.directory,
+        hits,
+        len(report) - hits,
+    )
+    self.binary_cache.prune()